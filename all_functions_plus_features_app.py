@@ -1,21 +1,163 @@
 import streamlit as st
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APIStatusError
 import time
+import asyncio
+import random
 from typing import List, Dict, Optional
 from pypdf import PdfReader
-from docx import Document
 import io
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-import plotly.graph_objects as go
+import plotly.io as pio
 import json
+import re
+import math
+import heapq
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+import numpy as np
+import os
+import bisect
+import importlib.util
+import hashlib
+import pickle
+import tempfile
+from collections import OrderedDict, Counter, defaultdict
+from types import SimpleNamespace
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # pyarrow is optional; pandas' C engine is used without it
+    pa = None
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional; token counts are estimated without it
+    tiktoken = None
+
+from app_data import (
+    EXCEL_BACKENDS, WorkbookSheet, as_dataframe, compact_dataframe, detach_frames, spill_dataframe
+)
+from app_pdf_worker import PDF_WORKER_SCRIPT
+from app_workers import (
+    PLOT_MAX_LINE_POINTS, PLOT_MAX_SCATTER_POINTS, PLOT_MAX_CLIENT_POINTS,
+    WorkerPool, configure_plot_style, detect_plot_library, render_plot, save_plot_to_bytes
+)
 
 # Set plotting defaults
-sns.set_style("whitegrid")
-plt.rcParams['figure.figsize'] = (10, 6)
-plt.rcParams['font.size'] = 10
+configure_plot_style()
+
+# PDF extraction settings
+PDF_PARALLEL_MIN_PAGES = 16  # Below this, handing pages to worker processes costs more than it saves
+PDF_PAGES_PER_TASK = 20  # Page range handed to each worker task
+PDF_WORKERS = min(os.cpu_count() or 1, 4)  # Extraction is spread over at most this many processes
+PDF_WORKER_IDLE_SECONDS = 300.0  # PDF workers idle this long are stopped; they restart on the next large PDF
+PDF_TASK_TIMEOUT_SECONDS = 120.0  # A page range that takes longer is extracted in the app instead
+
+# DOCX extraction settings
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'  # Legacy copy of a text box
+
+# Ingestion cache settings (shared by all sessions and processes on this host)
+PARSER_VERSION = "9"  # Bump whenever parsing output changes to invalidate old entries
+CACHE_ROOT = os.environ.get("DOC_CHAT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "doc_chat_assistant"))
+INGEST_CACHE_DIR = os.path.join(CACHE_ROOT, "ingest")
+INGEST_CACHE_MAX_BYTES = int(os.environ.get("DOC_CHAT_INGEST_CACHE_MB", "2048")) * 1024 * 1024
+INGEST_MEMORY_CACHE_ENTRIES = 32
+INGEST_POLL_SECONDS = 0.5  # Refresh interval of the upload progress widget while files are parsing
+SPILL_PIN_SECONDS = 3600  # Spill files a session used within this window are never evicted
+WORKBOOK_PREVIEW_ROWS = 10_000  # Longer sheets are summarized from this many rows and parsed in full on first use
+
+# Response cache settings (answers to identical questions about identical documents)
+RESPONSE_CACHE_DIR = os.path.join(CACHE_ROOT, "responses")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("DOC_CHAT_RESPONSE_CACHE_ENTRIES", "2000"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("DOC_CHAT_RESPONSE_CACHE_TTL_HOURS", "24")) * 3600
+
+# Dataframe profiling settings
+PROFILE_SAMPLE_ROWS = 100_000  # Statistics are estimated from a sample above this size
+PROFILE_CACHE_ENTRIES = 128
+PROFILE_BLOCK_COLUMNS = 64  # Numeric columns sorted together; bounds the temporaries on wide frames
+
+# Retrieval settings
+CHUNK_CHARS = 1_500  # Target chunk size for retrieval
+CHUNK_OVERLAP_CHARS = 200
+RETRIEVAL_MIN_CHARS = 24_000  # Document sets smaller than this are sent whole
+WHITESPACE_PATTERN = re.compile(r"\s+")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['_][a-z0-9]+)*")
+HASH_BUCKETS = 1 << 18  # Hashed term space; large enough that distinct terms rarely share a bucket
+VECTOR_DIM = 1024  # Dense dimensions the hashed TF-IDF vectors are randomly projected to
+PROJECTION_NONZEROS = 8  # Signed output dimensions each bucket is spread over
+PROJECTION_MULTIPLIERS = (  # Fixed odd constants, so projections match the vectors cached on disk
+    0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+    0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9,
+)
+RRF_K = 60  # Reciprocal rank fusion damping constant
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have in is it its of on or that the their this to was were "
+    "will with what which who how why when where do does did can could should would i you we they".split()
+)
+
+# Token budget settings
+CHAT_MODELS = {  # Model -> context window in tokens
+    "gpt-4o-mini": 128_000,
+    "gpt-4o": 128_000,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4-turbo": 128_000,
+    "gpt-3.5-turbo": 16_385,
+}
+DEFAULT_CHAT_MODEL = "gpt-4o-mini"
+RESPONSE_MAX_TOKENS = 1000
+MIN_DOCUMENT_TOKENS = 2_000  # Window share kept for documents; the reply reservation is clamped to leave it
+MIN_RESPONSE_TOKENS = 256  # The reply reservation is never clamped below this
+CHARS_PER_TOKEN = 4  # Estimate used when tiktoken is not installed
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separator tokens added per chat message
+TOKEN_SAFETY_MARGIN = 512  # Headroom for tokenizer differences and estimation error
+HISTORY_RECENT_TURNS = 4  # Question/answer pairs sent verbatim; older ones are summarized
+HISTORY_MAX_TOKENS = 6_000  # Ceiling for the chat history portion of a request
+SUMMARY_MAX_TOKENS = 400  # Length cap for the running summary of older turns
+HISTORY_SUMMARY_BATCH_TURNS = 4  # Aged-out turns stay verbatim until this many can be summarized in one call
+REQUEST_TIMEOUT_SECONDS = 60.0
+REQUEST_MAX_RETRIES = 4
+RETRY_BASE_SECONDS = 0.5  # Backoff before the first retry, doubled for each later one
+RETRY_MAX_SECONDS = 20.0
+RETRY_STATUS_CODES = frozenset({408, 409, 429})  # Retried alongside every 5xx status
+LLM_CLIENT_POOL_SIZE = 16  # Distinct API keys with a live client
+LLM_BACKENDS = ['openai', 'mock']
+DEFAULT_LLM_BACKEND = os.environ.get("DOC_CHAT_LLM_BACKEND", "openai")
+DEFAULT_LLM_BASE_URL = os.environ.get("DOC_CHAT_OPENAI_BASE_URL", "")  # Any OpenAI-compatible server
+MOCK_LATENCY_SECONDS = 0.3  # Mock backend: delay before the first token
+MOCK_TOKENS_PER_SECOND = 80.0  # Mock backend: generation speed
+MOCK_ANSWER_TOKENS = 120  # Mock backend: length of a plain answer
+MAP_SHARD_TOKENS = 12_000  # Context per map call in map-reduce answering
+MAP_MAX_TOKENS = 400  # Length cap for each partial answer
+MAP_CONCURRENCY = 8  # Map calls in flight at once
+NO_RELEVANT_INFO = "NO_RELEVANT_INFO"  # Map reply for shards that do not bear on the question
+STREAM_RENDER_SECONDS = 0.05  # Minimum interval between redraws of a streaming answer
+STREAM_CODE_PATTERN = re.compile(r"```python.*?(?:```|$)", re.DOTALL)  # Code is hidden while streaming, as in the chat log
+TRUNCATION_MARKER = "\n[... trimmed to fit the context window ...]\n"
+
+# Plot render cache settings
+PLOT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Rendered images and export bytes kept in memory
+EXPORT_MIME_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml', 'pdf': 'application/pdf', 'html': 'text/html'}
+KALEIDO_AVAILABLE = importlib.util.find_spec('kaleido') is not None  # Needed for Plotly image export
+CACHEABLE_PLOT_ERRORS = frozenset({'SyntaxError', 'NameError'})  # Failures that rerunning the same code can't fix
+
+# Plot isolation settings (generated plot code runs in separate clean interpreter processes)
+PLOT_ISOLATION_AVAILABLE = os.name == 'posix'  # Workers inherit their connection through pass_fds
+PLOT_WORKERS = 2
+PLOT_TIMEOUT_SECONDS = 30.0
+PLOT_MEMORY_LIMIT_MB = int(os.environ.get("DOC_CHAT_PLOT_MEMORY_MB", "4096"))  # Address space a worker may add
+
+# CSV/TSV streaming settings
+CSV_DTYPE_SAMPLE_ROWS = 10_000  # Rows sampled up front to pin column dtypes
+CSV_NA_VALUES = [  # pandas' default missing-value markers, so both CSV engines agree on nulls
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
 
 # Page configuration
 st.set_page_config(
@@ -29,11 +171,11 @@ st.set_page_config(
 if 'messages' not in st.session_state:
     st.session_state.messages = []
 if 'documents' not in st.session_state:
-    st.session_state.documents = []  # List of dicts with 'name', 'content', 'type', 'dataframe'
+    st.session_state.documents = []  # List of dicts with 'name', 'content', 'type', 'dataframes'
 if 'combined_content' not in st.session_state:
     st.session_state.combined_content = None
 if 'dataframes' not in st.session_state:
-    st.session_state.dataframes = {}  # Dict mapping filename to dataframe
+    st.session_state.dataframes = {}  # Dict mapping filename to dataframe (or SpilledFrame handle)
 if 'api_key' not in st.session_state:
     st.session_state.api_key = None
 if 'conversation_history' not in st.session_state:
@@ -46,10 +188,74 @@ if 'plot_width' not in st.session_state:
     st.session_state.plot_width = 10
 if 'plot_height' not in st.session_state:
     st.session_state.plot_height = 6
+if 'plot_downsample' not in st.session_state:
+    st.session_state.plot_downsample = True
+if 'plot_isolation' not in st.session_state:
+    st.session_state.plot_isolation = PLOT_ISOLATION_AVAILABLE
+if 'plot_timeout' not in st.session_state:
+    st.session_state.plot_timeout = PLOT_TIMEOUT_SECONDS
 if 'plot_format' not in st.session_state:
     st.session_state.plot_format = 'png'
 if 'dark_mode' not in st.session_state:
     st.session_state.dark_mode = True  # Default to dark mode (rainforest theme)
+if 'csv_engine' not in st.session_state:
+    st.session_state.csv_engine = 'auto'  # 'auto', 'pyarrow' or 'c'
+if 'ingest_memory_limit_mb' not in st.session_state:
+    st.session_state.ingest_memory_limit_mb = 2048  # Memory ceiling per data file
+if 'csv_chunk_rows' not in st.session_state:
+    st.session_state.csv_chunk_rows = 200_000
+if 'profile_sample_rows' not in st.session_state:
+    st.session_state.profile_sample_rows = PROFILE_SAMPLE_ROWS
+if 'compact_dtypes' not in st.session_state:
+    st.session_state.compact_dtypes = False  # Opt-in: categoricals change groupby/concat results
+if 'downcast_numeric' not in st.session_state:
+    st.session_state.downcast_numeric = False  # Opt-in on top of compact_dtypes
+if 'ingest_jobs' not in st.session_state:
+    st.session_state.ingest_jobs = {}  # Upload key -> background ingestion job
+if 'doc_registry' not in st.session_state:
+    st.session_state.doc_registry = {}  # Upload key -> {'doc', 'frames'} or {'error'}
+if 'bm25_index' not in st.session_state:
+    st.session_state.bm25_index = None  # BM25Index over text chunks, created on first registration
+if 'vector_index' not in st.session_state:
+    st.session_state.vector_index = None  # VectorIndex over the same chunks, created alongside
+if 'retrieval_mode' not in st.session_state:
+    st.session_state.retrieval_mode = 'hybrid'  # 'hybrid', 'keyword' (BM25) or 'semantic' (vectors)
+if 'chat_model' not in st.session_state:
+    st.session_state.chat_model = DEFAULT_CHAT_MODEL
+if 'response_max_tokens' not in st.session_state:
+    st.session_state.response_max_tokens = RESPONSE_MAX_TOKENS
+if 'request_log' not in st.session_state:
+    st.session_state.request_log = []  # One metrics dict per answered question, for the session aggregate and export
+if 'llm_backend' not in st.session_state:
+    st.session_state.llm_backend = DEFAULT_LLM_BACKEND  # 'openai' or 'mock' (offline, for load testing)
+if 'llm_base_url' not in st.session_state:
+    st.session_state.llm_base_url = DEFAULT_LLM_BASE_URL
+if 'mock_latency' not in st.session_state:
+    st.session_state.mock_latency = MOCK_LATENCY_SECONDS
+if 'mock_tokens_per_second' not in st.session_state:
+    st.session_state.mock_tokens_per_second = MOCK_TOKENS_PER_SECOND
+if 'request_timeout' not in st.session_state:
+    st.session_state.request_timeout = REQUEST_TIMEOUT_SECONDS
+if 'request_max_retries' not in st.session_state:
+    st.session_state.request_max_retries = REQUEST_MAX_RETRIES
+if 'response_cache_enabled' not in st.session_state:
+    st.session_state.response_cache_enabled = True
+if 'answer_mode' not in st.session_state:
+    st.session_state.answer_mode = 'retrieval'  # 'retrieval', 'map-reduce' or 'auto'
+if 'map_concurrency' not in st.session_state:
+    st.session_state.map_concurrency = MAP_CONCURRENCY
+if 'history_recent_turns' not in st.session_state:
+    st.session_state.history_recent_turns = HISTORY_RECENT_TURNS
+if 'history_max_tokens' not in st.session_state:
+    st.session_state.history_max_tokens = HISTORY_MAX_TOKENS
+if 'history_summary' not in st.session_state:
+    st.session_state.history_summary = None  # Running summary of older turns: 'covered', 'digest', 'text'
+if 'retrieval_top_k' not in st.session_state:
+    st.session_state.retrieval_top_k = 8
+if 'document_keys' not in st.session_state:
+    st.session_state.document_keys = []  # Upload keys of st.session_state.documents, in order
+if 'excel_backend' not in st.session_state:
+    st.session_state.excel_backend = 'auto'  # 'auto' prefers calamine when installed
 
 # Custom CSS - Glassmorphism Rainforest + Claymorphism UI/UX
 # Check dark mode state
@@ -1177,83 +1383,803 @@ else:
 """, unsafe_allow_html=True)
 
 
-@st.cache_data(show_spinner=False)
-def load_document(uploaded_file) -> tuple[Optional[str], str, str, Optional[pd.DataFrame]]:
-    """Cache document loading to avoid re-reading the same file
-    Returns: (content, filename, file_type, dataframe)
+@st.cache_resource(show_spinner=False)
+def get_pdf_worker_pool() -> WorkerPool:
+    """Process-wide pool of light PDF extraction workers, shared by every upload
+    Workers run app_pdf_worker (pypdf only), start when a large PDF needs them and exit when idle.
+    """
+    return WorkerPool(PDF_WORKERS, PLOT_MEMORY_LIMIT_MB, PDF_WORKER_SCRIPT, PDF_WORKER_IDLE_SECONDS)
+
+
+def extract_pdf_text(pdf_bytes: bytes, progress_callback=None) -> tuple[str, List[int]]:
+    """Extract PDF text, farming page ranges out to the shared PDF worker pool
+    Workers read the PDF from a temporary file, so tasks only carry its path and a page range.
+    Returns: (content, page_offsets) where page_offsets[i] is the character
+    offset at which page i + 1 starts in content
+    """
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    num_pages = len(pdf_reader.pages)
+    pages: List[Optional[str]] = [None] * num_pages
+    done = 0
+
+    workers = min(PDF_WORKERS, -(-num_pages // PDF_PAGES_PER_TASK))
+    if num_pages >= PDF_PARALLEL_MIN_PAGES and workers > 1 and PLOT_ISOLATION_AVAILABLE:
+        pool = get_pdf_worker_pool()
+        fd, pdf_path = tempfile.mkstemp(suffix='.pdf')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pdf_bytes)
+            # Threads only wait on the workers' pipes; the extraction runs in the worker processes
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf") as dispatcher:
+                futures = {
+                    dispatcher.submit(pool.run, 'pdf_pages', (pdf_path, start, min(start + PDF_PAGES_PER_TASK, num_pages)),
+                                      PDF_TASK_TIMEOUT_SECONDS): start
+                    for start in range(0, num_pages, PDF_PAGES_PER_TASK)
+                }
+                for future in as_completed(futures):
+                    try:
+                        texts = future.result().get('pages')
+                    except (TimeoutError, ChildProcessError):
+                        texts = None
+                    if texts is None:
+                        # Left for the serial pass below
+                        continue
+                    start = futures[future]
+                    pages[start:start + len(texts)] = texts
+                    done += len(texts)
+                    if progress_callback:
+                        progress_callback(done, num_pages)
+        except OSError:
+            # e.g. no writable temp directory; fall back to serial extraction
+            pass
+        finally:
+            try:
+                os.remove(pdf_path)
+            except OSError:
+                pass
+
+    for i, page_text in enumerate(pages):
+        if page_text is None:
+            pages[i] = pdf_reader.pages[i].extract_text() or ""
+            done += 1
+            if progress_callback:
+                progress_callback(done, num_pages)
+
+    # Join once at the end and remember where each page starts
+    page_offsets = []
+    offset = 0
+    for page_text in pages:
+        page_offsets.append(offset)
+        offset += len(page_text) + 1
+    content = "\n".join(pages) + "\n" if pages else ""
+    return content, page_offsets
+
+
+def extract_docx_text(data: bytes) -> str:
+    """Stream word/document.xml and emit paragraphs and tables in document order
+    Table rows become tab-separated lines (nested tables are flattened into their
+    cell). Paragraphs inside a text box are kept on their own lines within the
+    paragraph that anchors the box. Each top-level body element is cleared once
+    emitted, so memory stays flat.
+    """
+    lines = []
+    open_stack = []  # (tag, text pieces) of each open paragraph and table cell, innermost last
+    row_stack = []  # Cells of each open table row (nested tables push another row)
+    body = None
+    tags = []  # Tags of the open elements, so run content can be told apart from properties
+    fallback_depth = 0  # Inside mc:Fallback, which repeats a text box already read from mc:Choice
+
+    def emit(text: str, tag: str):
+        """Hand a finished paragraph or row to its enclosing paragraph or cell, or to the output"""
+        if not open_stack:
+            lines.append(text)
+        elif open_stack[-1][0] == 'p':
+            # Text box content: on its own lines inside the anchoring paragraph
+            open_stack[-1][1].append(f"\n{text}\n")
+        else:
+            open_stack[-1][1].append(text.replace("\t", " | ") if tag == 'tr' else text)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive, archive.open('word/document.xml') as xml:
+        for event, elem in ET.iterparse(xml, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                tags.append(tag)
+                if tag == MC_FALLBACK:
+                    fallback_depth += 1
+                elif fallback_depth:
+                    continue
+                elif tag == WORD_NS + 'body':
+                    body = elem
+                elif tag == WORD_NS + 'p':
+                    open_stack.append(('p', []))
+                elif tag == WORD_NS + 'tr':
+                    row_stack.append([])
+                elif tag == WORD_NS + 'tc':
+                    open_stack.append(('tc', []))
+                continue
+
+            tags.pop()
+            # Tabs and breaks are content only directly inside a run; w:pPr/w:tabs holds tab stop definitions
+            in_run = bool(tags) and tags[-1] == WORD_NS + 'r'
+            if tag == MC_FALLBACK:
+                fallback_depth -= 1
+            elif fallback_depth:
+                pass
+            elif tag == WORD_NS + 't' and open_stack:
+                open_stack[-1][1].append(elem.text or "")
+            elif tag == WORD_NS + 'tab' and in_run and open_stack:
+                open_stack[-1][1].append("\t")
+            elif tag in (WORD_NS + 'br', WORD_NS + 'cr') and in_run and open_stack:
+                open_stack[-1][1].append("\n")
+            elif tag == WORD_NS + 'p':
+                emit("".join(open_stack.pop()[1]), 'p')
+            elif tag == WORD_NS + 'tc':
+                cell_text = " ".join(piece for piece in open_stack.pop()[1] if piece)
+                row_stack[-1].append(" ".join(cell_text.split()))
+            elif tag == WORD_NS + 'tr':
+                emit("\t".join(row_stack.pop()), 'tr')
+
+            if len(tags) == 2 and body is not None:
+                # A top-level body element (paragraph or table) is finished
+                body.clear()
+
+    return "\n".join(lines)
+
+
+def page_for_offset(page_offsets: List[int], offset: int) -> int:
+    """Map a character offset in extracted PDF text back to a 1-based page number"""
+    return max(bisect.bisect_right(page_offsets, offset), 1)
+
+
+def read_delimited(data: bytes, sep: str, engine: str = 'auto', memory_limit_mb: int = 2048, chunk_rows: int = 200_000) -> tuple[pd.DataFrame, Dict]:
+    """Stream CSV/TSV bytes in chunks, stopping once the memory ceiling is reached
+    Returns: (dataframe, metadata) where metadata has rows, rows_per_sec, engine and truncated
+    """
+    start_time = time.perf_counter()
+    limit_bytes = memory_limit_mb * 1024 * 1024
+    if engine == 'auto':
+        engine = 'pyarrow' if pa is not None else 'c'
+    if engine == 'pyarrow' and pa is None:
+        raise ImportError("The pyarrow CSV engine requires: pip install pyarrow")
+
+    df = None
+    if engine == 'pyarrow':
+        try:
+            df, truncated = _read_csv_arrow(data, sep, limit_bytes)
+        except pa.ArrowInvalid:
+            # A later block held values the types inferred from the first block can't hold
+            engine = 'c'
+    if df is None:
+        # Pin dtypes from a sample so chunks skip per-chunk inference and agree with each other
+        sample = pd.read_csv(io.BytesIO(data), sep=sep, nrows=CSV_DTYPE_SAMPLE_ROWS)
+        dtypes = {col: dtype for col, dtype in sample.dtypes.items() if dtype.kind in 'fb' or (dtype.kind == 'i' and len(sample) < CSV_DTYPE_SAMPLE_ROWS)}
+        try:
+            chunks, truncated = _read_csv_chunks(data, sep, dtypes, chunk_rows, limit_bytes)
+        except (ValueError, TypeError):
+            # A pinned column held values the sample didn't see; let pandas infer instead
+            chunks, truncated = _read_csv_chunks(data, sep, None, chunk_rows, limit_bytes)
+        df = pd.concat(chunks, ignore_index=True) if chunks else sample.iloc[0:0]
+
+    elapsed = time.perf_counter() - start_time
+    return df, {
+        'rows': len(df),
+        'rows_per_sec': len(df) / elapsed if elapsed > 0 else float(len(df)),
+        'engine': engine,
+        'truncated': truncated,
+        'memory_limit_mb': memory_limit_mb
+    }
+
+
+def _read_csv_arrow(data: bytes, sep: str, limit_bytes: int) -> tuple[pd.DataFrame, bool]:
+    """Stream record batches with pyarrow until the memory ceiling would be exceeded
+    Nulls follow pandas' defaults and dates stay strings, so the frame matches pd.read_csv.
+    Raises pa.ArrowInvalid when a later block doesn't fit the types inferred from the first.
+    """
+    read_options = pa_csv.ReadOptions(block_size=max(1024 * 1024, min(16 * 1024 * 1024, limit_bytes // 8)))
+    parse_options = pa_csv.ParseOptions(delimiter=sep)
+    convert_options = pa_csv.ConvertOptions(null_values=CSV_NA_VALUES, strings_can_be_null=True)
+    reader = pa_csv.open_csv(io.BytesIO(data), read_options=read_options, parse_options=parse_options,
+                             convert_options=convert_options)
+    temporal = [field.name for field in reader.schema if pa.types.is_temporal(field.type)]
+    if temporal:
+        # pd.read_csv doesn't parse dates unless asked to; read those columns as text instead
+        convert_options.column_types = {name: pa.string() for name in temporal}
+        reader = pa_csv.open_csv(io.BytesIO(data), read_options=read_options, parse_options=parse_options,
+                                 convert_options=convert_options)
+
+    batches = []
+    used = 0
+    truncated = False
+    for batch in reader:
+        used += batch.nbytes
+        if used > limit_bytes:
+            truncated = True
+            break
+        batches.append(batch)
+    return pa.Table.from_batches(batches, schema=reader.schema).to_pandas(), truncated
+
+
+def _read_csv_chunks(data: bytes, sep: str, dtypes: Optional[Dict], chunk_rows: int, limit_bytes: int) -> tuple[List[pd.DataFrame], bool]:
+    """Read chunks with the C engine until the memory ceiling would be exceeded"""
+    chunks = []
+    used = 0
+    for chunk in pd.read_csv(io.BytesIO(data), sep=sep, dtype=dtypes, chunksize=chunk_rows, low_memory=False):
+        used += int(chunk.memory_usage(deep=True).sum())
+        if used > limit_bytes:
+            return chunks, True
+        chunks.append(chunk)
+    return chunks, False
+
+
+def get_var_name(filename: str) -> str:
+    """Create a clean dataframe variable name from a filename"""
+    var_name = filename.split('.')[0].replace(' ', '_').replace('-', '_')
+    return ''.join(c if c.isalnum() or c == '_' else '_' for c in var_name)
+
+
+def get_sheet_var_names(filename: str, sheet_names: List[str]) -> List[str]:
+    """Variable names for a workbook's sheets; single-sheet workbooks keep the file's name
+    Sheet names that sanitize to the same identifier ("Sheet 1", "Sheet_1") get a numeric suffix.
+    """
+    if len(sheet_names) == 1:
+        return [get_var_name(filename)]
+    var_names = []
+    for sheet_name in sheet_names:
+        sheet_part = ''.join(c if c.isalnum() else '_' for c in str(sheet_name))
+        var_names.append(unique_var_name(f"{get_var_name(filename)}_{sheet_part}", var_names))
+    return var_names
+
+
+def resolve_excel_backend(backend: str = 'auto') -> str:
+    """Pick the Excel backend, falling back to pandas' default reader when calamine isn't installed"""
+    if backend in ('auto', 'calamine'):
+        return 'calamine' if importlib.util.find_spec('python_calamine') else 'pandas default'
+    return backend
+
+
+def read_workbook(data: bytes, backend: str, on_sheet=None, preview_rows: int = None) -> tuple[Dict, Dict]:
+    """Parse a workbook one sheet at a time, handing each sheet to on_sheet(df, sheet_idx, sheet_names, partial)
+    With preview_rows, only that many rows of each sheet are read and partial tells whether the
+    sheet is longer. A sheet that fails to parse is skipped and its error recorded.
+    Returns: ({sheet_name: on_sheet result}, {sheet_names, sheet_seconds, sheet_errors, excel_backend})
+    """
+    workbook = EXCEL_BACKENDS[backend](data)
+    sheet_names = list(workbook.sheet_names)
+
+    frames = {}
+    sheet_seconds = {}
+    sheet_errors = {}
+    for sheet_idx, sheet_name in enumerate(sheet_names):
+        start_time = time.perf_counter()
+        try:
+            df = workbook.parse(sheet_name, nrows=preview_rows + 1 if preview_rows else None)
+        except Exception as e:
+            sheet_errors[sheet_name] = str(e) or type(e).__name__
+            continue
+        sheet_seconds[sheet_name] = time.perf_counter() - start_time
+        partial = preview_rows is not None and len(df) > preview_rows
+        if partial:
+            df = df.iloc[:preview_rows]
+        # Only one sheet is resident at a time when on_sheet spills it
+        frames[sheet_name] = on_sheet(df, sheet_idx, sheet_names, partial) if on_sheet else df
+    return frames, {'sheet_names': sheet_names, 'sheet_seconds': sheet_seconds,
+                    'sheet_errors': sheet_errors, 'excel_backend': backend}
+
+
+def summarize_sheet(df: pd.DataFrame, filename: str, sheet_name: str, var_name: str, num_sheets: int,
+                    sample_rows: int = None, partial: bool = False) -> str:
+    """Dataframe summary for one workbook sheet; partial marks a summary of only the first rows"""
+    label = filename if num_sheets == 1 else f"{filename} (sheet: {sheet_name})"
+    summary = get_dataframe_summary(df, label, var_name, sample_rows)
+    if partial:
+        summary += f"\n\nNote: this summary covers only the first {len(df):,} rows; the full sheet is loaded when code uses this dataframe."
+    return summary
+
+
+def join_sheet_summaries(summaries: Dict[str, str], filename: str, meta: Dict) -> str:
+    """Workbook content: sheet summaries in workbook order, with a note for each sheet that failed to parse"""
+    return "\n\n".join(
+        summaries[sheet_name] if sheet_name in summaries
+        else f"Sheet '{sheet_name}' of {filename} could not be read: {meta['sheet_errors'][sheet_name]}"
+        for sheet_name in meta['sheet_names']
+    )
+
+
+def summarize_workbook(frames: Dict, filename: str, meta: Dict, sample_rows: int = None) -> str:
+    """Concatenate the per-sheet summaries of a workbook, loading spilled sheets as needed"""
+    sheet_names = meta['sheet_names']
+    var_names = dict(zip(sheet_names, get_sheet_var_names(filename, sheet_names)))
+    summaries = {}
+    for sheet_name, df in frames.items():
+        partial = hasattr(df, 'preview')
+        summaries[sheet_name] = summarize_sheet(
+            df.preview(WORKBOOK_PREVIEW_ROWS) if partial else as_dataframe(df),
+            filename, sheet_name, var_names[sheet_name], len(sheet_names), sample_rows, partial
+        )
+    return join_sheet_summaries(summaries, filename, meta)
+
+
+def parse_document(data: bytes, filename: str, options: Dict = None, progress_callback=None, frame_sink=None,
+                   source_path: str = None) -> tuple[Optional[str], str, str, Optional[pd.DataFrame], Dict]:
+    """Parse raw upload bytes into text and an optional dataframe
+    Workbooks return a dict of {sheet_name: dataframe}. frame_sink(df, suffix), when
+    given, replaces each parsed dataframe (e.g. with a spill store handle). When source_path
+    holds a copy of a workbook, sheets longer than WORKBOOK_PREVIEW_ROWS become WorkbookSheet
+    handles that parse the full sheet the first time code reads it.
+    Returns: (content, filename, file_type, dataframe, metadata)
     """
+    options = options or {}
+    frame_sink = frame_sink or (lambda df, suffix: df)
+    footprint = {'memory_before': 0, 'memory_after': 0}
+
+    def compact(df: pd.DataFrame) -> pd.DataFrame:
+        """Apply the optional dtype compaction stage and tally the footprint"""
+        if not options.get('compact_dtypes'):
+            return df
+        df, before, after = compact_dataframe(df, downcast_numeric=options.get('downcast_numeric', False))
+        footprint['memory_before'] += before
+        footprint['memory_after'] += after
+        return df
+
     try:
-        file_extension = uploaded_file.name.split('.')[-1].lower()
-        
-        # Create a clean variable name from filename
-        var_name = uploaded_file.name.split('.')[0].replace(' ', '_').replace('-', '_')
-        var_name = ''.join(c if c.isalnum() or c == '_' else '_' for c in var_name)
+        file_extension = filename.split('.')[-1].lower()
+        var_name = get_var_name(filename)
         
         if file_extension == 'txt':
             # Handle TXT files
-            content = uploaded_file.read().decode('utf-8')
-            return content, uploaded_file.name, 'text', None
+            content = data.decode('utf-8')
+            return content, filename, 'text', None, {}
         
         elif file_extension == 'pdf':
             # Handle PDF files
-            pdf_reader = PdfReader(io.BytesIO(uploaded_file.read()))
-            content = ""
-            for page in pdf_reader.pages:
-                content += page.extract_text() + "\n"
-            return content, uploaded_file.name, 'text', None
+            content, page_offsets = extract_pdf_text(data, progress_callback)
+            return content, filename, 'text', None, {'page_offsets': page_offsets}
         
         elif file_extension in ['doc', 'docx']:
-            # Handle DOC/DOCX files
-            doc = Document(io.BytesIO(uploaded_file.read()))
-            content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-            return content, uploaded_file.name, 'text', None
-        
-        elif file_extension == 'csv':
-            # Handle CSV files
-            df = pd.read_csv(uploaded_file)
-            content = get_dataframe_summary(df, uploaded_file.name, var_name)
-            return content, uploaded_file.name, 'data', df
+            # Handle DOC/DOCX files (legacy binary .doc files are not zip packages and fail here)
+            content = extract_docx_text(data)
+            return content, filename, 'text', None, {}
         
-        elif file_extension == 'tsv':
-            # Handle TSV files
-            df = pd.read_csv(uploaded_file, sep='\t')
-            content = get_dataframe_summary(df, uploaded_file.name, var_name)
-            return content, uploaded_file.name, 'data', df
+        elif file_extension in ['csv', 'tsv']:
+            # Handle CSV/TSV files in memory-bounded chunks
+            df, meta = read_delimited(
+                data,
+                sep=',' if file_extension == 'csv' else '\t',
+                engine=options.get('csv_engine', 'auto'),
+                memory_limit_mb=options.get('memory_limit_mb', 2048),
+                chunk_rows=options.get('chunk_rows', 200_000)
+            )
+            df = compact(df)
+            content = get_dataframe_summary(df, filename, var_name, options.get('profile_sample_rows'))
+            if meta['truncated']:
+                content += f"\n\nNote: only the first {meta['rows']:,} rows were loaded (memory limit {meta['memory_limit_mb']:,} MB)."
+            if options.get('compact_dtypes'):
+                meta.update(footprint)
+            return content, filename, 'data', frame_sink(df, ''), meta
         
         elif file_extension in ['xlsx', 'xls']:
-            # Handle Excel files
-            df = pd.read_excel(uploaded_file)
-            content = get_dataframe_summary(df, uploaded_file.name, var_name)
-            return content, uploaded_file.name, 'data', df
+            # Handle Excel files: every sheet becomes its own dataframe
+            backend = resolve_excel_backend(options.get('excel_backend', 'auto'))
+            compact_options = {'downcast_numeric': options.get('downcast_numeric', False)} if options.get('compact_dtypes') else None
+            summaries = {}
+
+            def summarize_and_sink(df: pd.DataFrame, sheet_idx: int, sheet_names: List[str], partial: bool):
+                sheet_name = sheet_names[sheet_idx]
+                var_name = get_sheet_var_names(filename, sheet_names)[sheet_idx]
+                if partial:
+                    # Summarize the preview; the rest of the sheet is parsed only if code reads it
+                    if compact_options:
+                        df = compact_dataframe(df, **compact_options)[0]
+                    summaries[sheet_name] = summarize_sheet(df, filename, sheet_name, var_name, len(sheet_names),
+                                                            options.get('profile_sample_rows'), partial=True)
+                    return WorkbookSheet(source_path, backend, sheet_name, f"{os.path.splitext(source_path)[0]}-{sheet_idx + 1}.arrow",
+                                         list(df.columns), df.head(10), compact_options)
+                # Summarize while the sheet is resident, then hand it to the sink
+                df = compact(df)
+                summaries[sheet_name] = summarize_sheet(df, filename, sheet_name, var_name, len(sheet_names), options.get('profile_sample_rows'))
+                return frame_sink(df, f"-{sheet_idx + 1}")
+
+            frames, meta = read_workbook(data, backend, summarize_and_sink, WORKBOOK_PREVIEW_ROWS if source_path else None)
+            if not frames:
+                return None, filename, 'error', None, {'error': f"Error reading file: no sheet could be read ({'; '.join(meta['sheet_errors'].values())})"}
+            content = join_sheet_summaries(summaries, filename, meta)
+            if options.get('compact_dtypes'):
+                meta.update(footprint)
+            return content, filename, 'data', frames, meta
         
         else:
-            st.error(f"Unsupported file type: {file_extension}")
-            return None, uploaded_file.name, 'unknown', None
+            # Errors are reported through metadata because parsing may run in a worker thread
+            return None, filename, 'unknown', None, {'error': f"Unsupported file type: {file_extension}"}
     
     except Exception as e:
-        st.error(f"Error reading file: {str(e)}")
-        return None, uploaded_file.name, 'error', None
+        return None, filename, 'error', None, {'error': f"Error reading file: {str(e)}"}
+
+
+def spill_path(key: str) -> str:
+    """Location of a spill file in the ingestion cache"""
+    return os.path.join(INGEST_CACHE_DIR, f"{key}.arrow")
+
+
+def save_workbook_source(data: bytes, key: str) -> Optional[str]:
+    """Keep a copy of an uploaded workbook next to its spill files so long sheets can be parsed later
+    Returns the path, or None when the cache directory isn't writable.
+    """
+    path = os.path.join(INGEST_CACHE_DIR, f"{key}.workbook")
+    try:
+        os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=INGEST_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        return None
+    return path
+
+
+def resolve_dataframes(dataframes: Dict, code: str = None) -> Dict[str, pd.DataFrame]:
+    """Load the dataframes a code block needs (all of them when no code is given)"""
+    if code is None or len(dataframes) == 1:
+        return {name: as_dataframe(df) for name, df in dataframes.items()}
+    return {name: as_dataframe(df) for name, df in dataframes.items() if name in code}
+
+
+def ingest_cache_key(data: bytes, filename: str, options: Dict = None) -> str:
+    """Content-address an upload by its bytes, extension, parser version and options"""
+    file_extension = filename.split('.')[-1].lower()
+    options_key = json.dumps(options or {}, sort_keys=True)
+    digest = hashlib.sha256(f"{PARSER_VERSION}:{file_extension}:{options_key}:".encode())
+    digest.update(data)
+    return digest.hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingest_memory_cache() -> OrderedDict:
+    """Process-wide in-memory tier in front of the on-disk ingestion cache"""
+    return OrderedDict()
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingest_cache_lock() -> threading.Lock:
+    """Guards the memory tier, which ingestion worker threads share"""
+    return threading.Lock()
+
+
+def _remember_ingest(key: str, entry: Optional[Dict]):
+    """Insert (or, with entry=None, drop) a memory tier entry and trim it to size"""
+    memory_cache = get_ingest_memory_cache()
+    with get_ingest_cache_lock():
+        if entry is None:
+            memory_cache.pop(key, None)
+            return
+        memory_cache[key] = entry
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > INGEST_MEMORY_CACHE_ENTRIES:
+            memory_cache.popitem(last=False)
+
+
+def ingest_cache_get(key: str) -> Optional[Dict]:
+    """Look up a parsed upload in memory, then on disk (refreshing its LRU position)"""
+    entry = get_ingest_memory_cache().get(key)
+    if entry is None:
+        path = os.path.join(INGEST_CACHE_DIR, f"{key}.pkl")
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+
+    frames = entry["dataframe"]
+    frames = frames.values() if isinstance(frames, dict) else [frames]
+    if any(path and not os.path.exists(path)
+           for df in frames for path in (getattr(df, 'path', None), getattr(df, 'source_path', None))):
+        # A spill file or cached workbook was evicted independently; treat as a miss and re-parse
+        _remember_ingest(key, None)
+        return None
+
+    _remember_ingest(key, entry)
+    return entry
+
+
+def ingest_cache_put(key: str, entry: Dict):
+    """Store a parsed upload on disk atomically, then evict least recently used entries"""
+    _remember_ingest(key, entry)
+
+    tmp_path = None
+    try:
+        os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=INGEST_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(INGEST_CACHE_DIR, f"{key}.pkl"))
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        # The cache is an optimization; a read-only or full disk, or an entry that can't be
+        # pickled, must not break uploads (the memory tier above still holds the entry)
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return
+    evict_ingest_cache()
+
+
+@st.cache_resource(show_spinner=False)
+def get_spill_pins() -> Dict:
+    """Process-wide map of spill file path -> last time a live session referenced it"""
+    return {"lock": threading.Lock(), "paths": {}}
+
+
+def pin_spill_files(dataframes: Dict):
+    """Protect the spill files behind a session's dataframes from eviction"""
+    pins = get_spill_pins()
+    now = time.time()
+    with pins["lock"]:
+        for df in dataframes.values():
+            # Lazy workbook sheets also need their workbook and the spill file they will write
+            for path in (getattr(df, 'path', None), getattr(df, 'source_path', None), getattr(df, 'spill_path', None)):
+                if path:
+                    pins["paths"][path] = now
+        # Sessions that went away stop refreshing their pins; forget those after a while
+        for path, pinned_at in list(pins["paths"].items()):
+            if now - pinned_at > SPILL_PIN_SECONDS:
+                del pins["paths"][path]
+
+
+def evict_ingest_cache(max_bytes: int = None):
+    """Delete the least recently used cache files until the cache fits in max_bytes
+    Spill files pinned by live sessions are kept even when that leaves the cache over budget.
+    """
+    max_bytes = INGEST_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    pins = get_spill_pins()
+    with pins["lock"]:
+        pinned = set(pins["paths"])
+    entries = []
+    try:
+        with os.scandir(INGEST_CACHE_DIR) as it:
+            for entry in it:
+                if entry.path in pinned:
+                    continue
+                if entry.name.endswith(('.pkl', '.arrow', '.npy', '.npz', '.workbook')):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # Another process may have evicted it already
+            pass
+        total -= size
+
 
+def load_document(uploaded_file, options: Dict = None, progress_callback=None) -> tuple[Optional[str], str, str, Optional[pd.DataFrame], Dict]:
+    """Load an uploaded file through the persistent ingestion cache
+    Returns: (content, filename, file_type, dataframe, metadata)
+    """
+    data = uploaded_file.getvalue()
+    key = ingest_cache_key(data, uploaded_file.name, options)
+
+    entry = ingest_cache_get(key)
+    if entry is None:
+        is_workbook = uploaded_file.name.split('.')[-1].lower() in ('xlsx', 'xls')
+        source_path = save_workbook_source(data, key) if is_workbook else None
+        content, _, file_type, df, meta = parse_document(
+            data, uploaded_file.name, options, progress_callback,
+            frame_sink=lambda frame, suffix: spill_dataframe(frame, spill_path(f"{key}{suffix}")),
+            source_path=source_path
+        )
+        if source_path and not (isinstance(df, dict) and any(hasattr(frame, 'source_path') for frame in df.values())):
+            # Every sheet was read in full, so the workbook copy isn't needed
+            try:
+                os.remove(source_path)
+            except OSError:
+                pass
+        if content is None:
+            return content, uploaded_file.name, file_type, df, meta
+        if file_type == 'text':
+            # Retrieval chunks and their vectors are part of the ingestion output
+            meta['chunks'] = chunk_text(content, meta.get('page_offsets'))
+            save_chunk_vectors(key, embed_texts([chunk['text'] for chunk in meta['chunks']]))
+        entry = {"name": uploaded_file.name, "content": content, "type": file_type, "dataframe": df, "meta": meta}
+        ingest_cache_put(key, entry)
+
+    content = entry["content"]
+    # Memory tier entries are shared by every session in this process
+    df = detach_frames(entry["dataframe"])
+    if df is not None and entry["name"] != uploaded_file.name:
+        # Same bytes uploaded under another name: only the summary headers differ
+        if isinstance(df, dict):
+            content = summarize_workbook(df, uploaded_file.name, entry["meta"], (options or {}).get('profile_sample_rows'))
+        else:
+            content = get_dataframe_summary(
+                as_dataframe(df), uploaded_file.name, get_var_name(uploaded_file.name), (options or {}).get('profile_sample_rows')
+            )
+    meta = entry["meta"]
+    if 'chunks' in meta:
+        meta = {**meta, 'chunk_vectors': load_chunk_vectors(key, meta['chunks'])}
+    return content, uploaded_file.name, entry["type"], df, meta
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingest_executor() -> ThreadPoolExecutor:
+    """Process-wide thread pool that parses uploads concurrently"""
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="ingest")
+
+
+def get_upload_key(uploaded_file, options: Dict) -> str:
+    """Identify one upload of one file under one set of ingestion options"""
+    file_id = getattr(uploaded_file, 'file_id', None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    return f"{file_id}:{json.dumps(options, sort_keys=True)}"
+
+
+def start_ingest_job(uploaded_file, options: Dict) -> Dict:
+    """Submit an upload to the ingestion pool; progress is polled by later reruns"""
+    job = {"name": uploaded_file.name, "progress": None, "started": time.perf_counter()}
+
+    def record_progress(done: int, total: int):
+        job["progress"] = (done, total)
+
+    job["future"] = get_ingest_executor().submit(load_document, uploaded_file, options, record_progress)
+    return job
+
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """Content fingerprint: shape, schema and a vectorized hash of every value and index label"""
+    digest = hashlib.sha256(f"{df.shape}|{list(df.columns)}|{list(df.dtypes.astype(str))}".encode())
+    digest.update(pd.util.hash_pandas_object(df.index).to_numpy().tobytes())
+    for position in range(df.shape[1]):
+        column = df.iloc[:, position]
+        try:
+            hashed = pd.util.hash_pandas_object(column, index=False)
+        except TypeError:
+            # Unhashable cells (lists, dicts); hash their text form instead
+            hashed = pd.util.hash_pandas_object(column.astype(str), index=False)
+        digest.update(hashed.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def get_profile_cache() -> OrderedDict:
+    """Process-wide LRU of dataframe profiles keyed by fingerprint"""
+    return OrderedDict()
+
+
+@st.cache_resource(show_spinner=False)
+def get_profile_cache_lock() -> threading.Lock:
+    """Guards the profile cache, which ingestion worker threads share"""
+    return threading.Lock()
+
+
+def profile_cache_key(df: pd.DataFrame, sample: pd.DataFrame, null_counts: pd.Series, sample_rows: int) -> str:
+    """Key a profile by everything it is computed from: shape, schema, exact null counts and the sampled rows
+    The sample positions depend only on the row count, so hashing the sample (not the whole
+    frame) identifies the profile exactly at a fraction of the cost.
+    """
+    digest = hashlib.sha256(f"{sample_rows}|{list(null_counts.to_numpy())}".encode())
+    digest.update(dataframe_fingerprint(sample).encode())
+    return f"{df.shape}|{digest.hexdigest()}"
+
+
+def numeric_block_stats(values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Means, standard deviations and (min, quartiles, max) of each column of a float block
+    The block is sorted per column: NaNs sort last, so quantiles are direct lookups and every
+    statistic comes from whole-block operations.
+    """
+    columns = np.sort(values.T, axis=1)
+    missing = np.isnan(columns)
+    valid = columns.shape[1] - missing.sum(axis=1)
+    with np.errstate(all='ignore'):
+        means = np.where(missing, 0.0, columns).sum(axis=1) / valid
+        deviations = np.where(missing, 0.0, columns - means[:, None])
+        stds = np.where(valid > 1, np.sqrt((deviations * deviations).sum(axis=1) / (valid - 1)), np.nan)
+        positions = np.outer([0.0, 0.25, 0.5, 0.75, 1.0], np.maximum(valid - 1, 0))
+        lower = np.floor(positions).astype(np.intp)
+        upper = np.ceil(positions).astype(np.intp)
+        rows = np.arange(columns.shape[0])
+        quantiles = columns[rows, lower] + (columns[rows, upper] - columns[rows, lower]) * (positions - lower)
+    quantiles[:, valid == 0] = np.nan
+    return means, stds, quantiles
+
+
+def profile_dataframe(df: pd.DataFrame, sample_rows: int = None) -> Dict:
+    """Profile a dataframe with vectorized operations over blocks of columns
+    Null counts are exact; numeric and categorical statistics come from a random
+    sample of sample_rows rows when the frame is larger than that.
+    Returns: dict with 'dtypes', 'nulls', 'numeric', 'categorical' and 'sampled_rows'
+    """
+    sample_rows = sample_rows or PROFILE_SAMPLE_ROWS
+    null_counts = df.isna().sum()
+    sample = df if len(df) <= sample_rows else df.sample(n=sample_rows, random_state=0)
+    key = profile_cache_key(df, sample, null_counts, sample_rows)
+    cache = get_profile_cache()
+    with get_profile_cache_lock():
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
 
-def get_dataframe_summary(df: pd.DataFrame, filename: str, var_name: str) -> str:
+    numeric = sample.select_dtypes(include='number')
+    numeric_stats = None
+    if numeric.shape[1]:
+        # Fixed-size column blocks keep the sorted copy and its temporaries small on wide frames
+        blocks = [
+            numeric_block_stats(numeric.iloc[:, start:start + PROFILE_BLOCK_COLUMNS].to_numpy(dtype='float64', na_value=np.nan))
+            for start in range(0, numeric.shape[1], PROFILE_BLOCK_COLUMNS)
+        ]
+        means = np.concatenate([block[0] for block in blocks])
+        stds = np.concatenate([block[1] for block in blocks])
+        quantiles = np.concatenate([block[2] for block in blocks], axis=1)
+        numeric_stats = pd.DataFrame(
+            [
+                (len(df) - null_counts[numeric.columns]).to_numpy(dtype='float64'),
+                means,
+                stds,
+                *quantiles
+            ],
+            index=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'],
+            columns=numeric.columns
+        )
+
+    categorical = sample.select_dtypes(exclude=['number', 'datetime', 'timedelta'])
+    categorical_stats = None
+    if categorical.shape[1]:
+        rows = {}
+        for col in categorical.columns:
+            counts = categorical[col].value_counts(dropna=True)
+            rows[col] = {
+                'count': len(df) - null_counts[col],
+                'unique': len(counts),
+                'top': counts.index[0] if len(counts) else None,
+                'freq': counts.iloc[0] if len(counts) else None
+            }
+        categorical_stats = pd.DataFrame(rows)
+
+    profile = {
+        'dtypes': df.dtypes,
+        'nulls': null_counts,
+        'numeric': numeric_stats,
+        'categorical': categorical_stats,
+        'sampled_rows': len(sample) if len(sample) < len(df) else None
+    }
+    with get_profile_cache_lock():
+        cache[key] = profile
+        while len(cache) > PROFILE_CACHE_ENTRIES:
+            cache.popitem(last=False)
+    return profile
+
+
+def get_dataframe_summary(df: pd.DataFrame, filename: str, var_name: str, sample_rows: int = None) -> str:
     """Generate a comprehensive summary of a dataframe for AI context"""
-    summary = f"Data File: {filename}\n"
-    summary += f"DataFrame variable name: {var_name}\n"
-    summary += f"Shape: {df.shape[0]} rows × {df.shape[1]} columns\n\n"
-    
-    summary += "Column Information:\n"
-    for col in df.columns:
-        dtype = df[col].dtype
-        null_count = df[col].isnull().sum()
-        summary += f"  - {col} ({dtype}): {null_count} missing values\n"
-    
-    summary += "\nFirst 5 rows:\n"
-    summary += df.head().to_string()
-    
-    summary += "\n\nStatistical Summary:\n"
-    summary += df.describe().to_string()
-    
-    return summary
+    profile = profile_dataframe(df, sample_rows)
+    parts = [
+        f"Data File: {filename}\n",
+        f"DataFrame variable name: {var_name}\n",
+        f"Shape: {df.shape[0]} rows × {df.shape[1]} columns\n\n",
+        "Column Information:\n"
+    ]
+    parts.extend(
+        f"  - {col} ({dtype}): {null_count} missing values\n"
+        for col, dtype, null_count in zip(df.columns, profile['dtypes'], profile['nulls'])
+    )
+
+    parts.append("\nFirst 5 rows:\n")
+    parts.append(df.head().to_string())
+
+    if profile['sampled_rows']:
+        parts.append(f"\n\nStatistical Summary (estimated from a {profile['sampled_rows']:,}-row sample):\n")
+    else:
+        parts.append("\n\nStatistical Summary:\n")
+    if profile['numeric'] is not None:
+        parts.append(profile['numeric'].to_string())
+    elif profile['categorical'] is not None:
+        parts.append(profile['categorical'].to_string())
+
+    return "".join(parts)
 
 
 @st.cache_data(show_spinner=False)
@@ -1269,86 +2195,1024 @@ def get_document_stats(content: str) -> Dict[str, int]:
     }
 
 
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens for retrieval, without very common English words"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def chunk_text(content: str, page_offsets: List[int] = None, chunk_chars: int = None, overlap_chars: int = None) -> List[Dict]:
+    """Split text into overlapping chunks, preferring paragraph and line boundaries
+    Returns: list of {'text', 'start', 'page'} (page is None for non-PDF text)
+    """
+    chunk_chars = chunk_chars or CHUNK_CHARS
+    overlap_chars = CHUNK_OVERLAP_CHARS if overlap_chars is None else overlap_chars
+    chunks = []
+    start = 0
+    while start < len(content):
+        end = min(start + chunk_chars, len(content))
+        if end < len(content):
+            # Back up to a natural break in the second half of the window
+            for separator in ("\n\n", "\n", ". ", " "):
+                cut = content.rfind(separator, start + chunk_chars // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        text = content[start:end].strip()
+        if text:
+            chunks.append({
+                'text': text,
+                'start': start,
+                'page': page_for_offset(page_offsets, start) if page_offsets else None
+            })
+        if end >= len(content):
+            break
+        next_start = max(end - overlap_chars, start + 1)
+        # Begin the overlap on a word boundary
+        boundary = WHITESPACE_PATTERN.search(content, next_start, end)
+        start = boundary.end() if boundary else next_start
+    return chunks
+
+
+class BM25Index:
+    """In-memory BM25 inverted index over document chunks, updated per document"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # term -> {chunk_id: term frequency}
+        self.chunks = {}  # chunk_id -> {'doc_key', 'doc_name', 'text', 'page', 'length', 'terms'}
+        self.doc_chunks = {}  # doc_key -> [chunk_id, ...]
+        self.total_length = 0
+        self.next_id = 0
+
+    def add_document(self, doc_key: str, doc_name: str, chunks: List[Dict]):
+        """Index the chunks of one document"""
+        self.remove_document(doc_key)
+        chunk_ids = []
+        for position, chunk in enumerate(chunks):
+            counts = Counter(tokenize(chunk['text']))
+            chunk_id = self.next_id
+            self.next_id += 1
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[chunk_id] = tf
+            length = sum(counts.values())
+            self.chunks[chunk_id] = {
+                'doc_key': doc_key, 'doc_name': doc_name, 'text': chunk['text'],
+                'page': chunk.get('page'), 'position': position, 'length': length, 'terms': list(counts)
+            }
+            self.total_length += length
+            chunk_ids.append(chunk_id)
+        self.doc_chunks[doc_key] = chunk_ids
+
+    def remove_document(self, doc_key: str):
+        """Drop every chunk of one document from the index"""
+        for chunk_id in self.doc_chunks.pop(doc_key, []):
+            chunk = self.chunks.pop(chunk_id)
+            self.total_length -= chunk['length']
+            for term in chunk['terms']:
+                postings = self.postings[term]
+                del postings[chunk_id]
+                if not postings:
+                    del self.postings[term]
+
+    def search(self, query: str, top_k: int = 8) -> List[tuple[float, Dict]]:
+        """Return the top_k (score, chunk) pairs for a query"""
+        num_chunks = len(self.chunks)
+        if not num_chunks:
+            return []
+        avg_length = self.total_length / num_chunks or 1.0
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.chunks[chunk_id]['length'] / avg_length)
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in best]
+
+
+def embed_texts(texts: List[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sparse hashed sublinear term-frequency vectors, as CSR arrays (indptr, indices, values)
+    Tokens are bucketed into HASH_BUCKETS with a stable CRC32 (Python's hash() is salted per
+    process). IDF weighting and the projection to dense vectors are applied by VectorIndex
+    over the whole corpus, so the cached vectors stay valid as documents come and go.
+    """
+    indptr = [0]
+    indices = []
+    values = []
+    for text in texts:
+        buckets = defaultdict(float)
+        for token, tf in Counter(tokenize(text)).items():
+            buckets[zlib.crc32(token.encode()) % HASH_BUCKETS] += 1.0 + math.log(tf)
+        indices.extend(buckets)
+        values.extend(buckets.values())
+        indptr.append(len(indices))
+    return np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32), np.array(values, dtype=np.float32)
+
+
+def project_vectors(vectors: tuple[np.ndarray, np.ndarray, np.ndarray], idf: np.ndarray, dim: int) -> np.ndarray:
+    """IDF-weight sparse hashed vectors and randomly project them to L2-normalized dense rows
+    Each bucket is spread over PROJECTION_NONZEROS output dimensions with random signs (a
+    sparse Johnson-Lindenstrauss projection), derived by multiplicative hashing of the bucket
+    so no projection matrix has to be stored.
+    """
+    indptr, indices, values = vectors
+    num_rows = len(indptr) - 1
+    rows = np.repeat(np.arange(num_rows, dtype=np.int64), np.diff(indptr))
+    weights = values * idf[indices] / np.float32(math.sqrt(PROJECTION_NONZEROS))
+    keys = indices.astype(np.uint64) + np.uint64(1)
+    flat_positions = []
+    flat_weights = []
+    for multiplier in PROJECTION_MULTIPLIERS[:PROJECTION_NONZEROS]:
+        hashed = keys * np.uint64(multiplier)  # Wraps modulo 2**64; the high bits are well mixed
+        flat_positions.append(rows * dim + ((hashed >> np.uint64(40)) % np.uint64(dim)).astype(np.int64))
+        flat_weights.append(np.where((hashed >> np.uint64(39)) & np.uint64(1), weights, -weights))
+    dense = np.bincount(
+        np.concatenate(flat_positions), weights=np.concatenate(flat_weights), minlength=num_rows * dim
+    ).reshape(num_rows, dim).astype(np.float32)
+    dense /= np.maximum(np.linalg.norm(dense, axis=1, keepdims=True), 1e-12)
+    return dense
+
+
+def save_chunk_vectors(key: str, vectors: tuple[np.ndarray, np.ndarray, np.ndarray]):
+    """Persist chunk vectors next to the ingestion cache entry they belong to"""
+    try:
+        os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=INGEST_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, indptr=vectors[0], indices=vectors[1], values=vectors[2])
+        os.replace(tmp_path, os.path.join(INGEST_CACHE_DIR, f"{key}.npz"))
+    except OSError:
+        pass
+
+
+def load_chunk_vectors(key: str, chunks: List[Dict]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Load persisted chunk vectors, re-embedding if they were evicted"""
+    path = os.path.join(INGEST_CACHE_DIR, f"{key}.npz")
+    try:
+        with np.load(path) as stored:
+            vectors = (stored['indptr'], stored['indices'], stored['values'])
+        os.utime(path)
+        if len(vectors[0]) == len(chunks) + 1:
+            return vectors
+    except (OSError, ValueError, KeyError):
+        pass
+    vectors = embed_texts([chunk['text'] for chunk in chunks])
+    save_chunk_vectors(key, vectors)
+    return vectors
+
+
+class VectorIndex:
+    """Cosine top-k search over projected hashed TF-IDF chunk vectors held in one contiguous float32 matrix"""
+
+    def __init__(self, dim: int = None):
+        self.dim = dim or VECTOR_DIM
+        self.doc_vectors = {}  # doc_key -> raw (unweighted) sparse chunk vectors from embed_texts
+        self.doc_chunks = {}  # doc_key -> chunk records, row-aligned with doc_vectors
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self.rows = []  # Chunk record for each matrix row
+        self.idf = np.ones(HASH_BUCKETS, dtype=np.float32)
+        self.dirty = False
+
+    def add_document(self, doc_key: str, doc_name: str, chunks: List[Dict], vectors: tuple[np.ndarray, np.ndarray, np.ndarray]):
+        """Register one document's chunk vectors; the matrix is rebuilt lazily"""
+        self.doc_vectors[doc_key] = vectors
+        self.doc_chunks[doc_key] = [
+            {'doc_key': doc_key, 'doc_name': doc_name, 'text': chunk['text'], 'page': chunk.get('page'), 'position': position}
+            for position, chunk in enumerate(chunks)
+        ]
+        self.dirty = True
+
+    def remove_document(self, doc_key: str):
+        """Forget one document's chunks"""
+        if self.doc_vectors.pop(doc_key, None) is not None:
+            self.doc_chunks.pop(doc_key, None)
+            self.dirty = True
+
+    def _rebuild(self):
+        """Re-weight every row by bucket IDF and project into one contiguous normalized matrix"""
+        self.rows = [chunk for key in self.doc_vectors for chunk in self.doc_chunks[key]]
+        if not self.rows:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        else:
+            stored = list(self.doc_vectors.values())
+            row_lengths = np.concatenate([np.diff(vectors[0]) for vectors in stored])
+            indptr = np.concatenate([[0], np.cumsum(row_lengths)])
+            indices = np.concatenate([vectors[1] for vectors in stored])
+            values = np.concatenate([vectors[2] for vectors in stored])
+            # Buckets are unique within a row, so bucket counts are document frequencies
+            doc_freq = np.bincount(indices, minlength=HASH_BUCKETS)
+            self.idf = (np.log((1 + len(self.rows)) / (1 + doc_freq)) + 1).astype(np.float32)
+            self.matrix = np.ascontiguousarray(project_vectors((indptr, indices, values), self.idf, self.dim))
+        self.dirty = False
+
+    def search_many(self, queries: List[str], top_k: int = 8) -> List[List[tuple[float, Dict]]]:
+        """Batched cosine search: one matrix product scores every query against every chunk"""
+        if self.dirty:
+            self._rebuild()
+        if not self.rows or not queries:
+            return [[] for _ in queries]
+        query_vectors = project_vectors(embed_texts(queries), self.idf, self.dim)
+        scores = query_vectors @ self.matrix.T
+        top_k = min(top_k, len(self.rows))
+        results = []
+        for row_scores in scores:
+            best = np.argpartition(-row_scores, top_k - 1)[:top_k]
+            best = best[np.argsort(-row_scores[best])]
+            results.append([(float(row_scores[i]), self.rows[i]) for i in best if row_scores[i] > 0])
+        return results
+
+    def search(self, query: str, top_k: int = 8) -> List[tuple[float, Dict]]:
+        """Return the top_k (cosine similarity, chunk) pairs for a query"""
+        return self.search_many([query], top_k)[0]
+
+
+def fuse_rankings(rankings: List[List[tuple[float, Dict]]], top_k: int) -> List[tuple[float, Dict]]:
+    """Reciprocal rank fusion of several ranked hit lists, matching chunks by document and position"""
+    fused = {}
+    for ranking in rankings:
+        for rank, (_, chunk) in enumerate(ranking):
+            chunk_key = (chunk['doc_key'], chunk['position'])
+            score, _ = fused.get(chunk_key, (0.0, chunk))
+            fused[chunk_key] = (score + 1.0 / (RRF_K + rank + 1), chunk)
+    return heapq.nlargest(top_k, fused.values(), key=lambda hit: hit[0])
+
+
+def build_retrieval_context(query: str, documents: List[Dict], top_k: int = None) -> List[str]:
+    """Document context for one question, one section per document: data file summaries plus
+    the best-matching text chunks. Small document sets are sent whole, since retrieval would only lose context.
+    """
+    combined = st.session_state.combined_content or ""
+    if len(combined) <= RETRIEVAL_MIN_CHARS or st.session_state.bm25_index is None:
+        return [format_document_section(idx, doc) for idx, doc in enumerate(documents, 1)]
+
+    sections = [
+        format_document_section(idx, doc)
+        for idx, doc in enumerate(documents, 1) if doc['type'] == 'data'
+    ]
+    top_k = top_k or st.session_state.retrieval_top_k
+    mode = st.session_state.retrieval_mode
+    rankings = []
+    if mode in ('hybrid', 'keyword'):
+        rankings.append(st.session_state.bm25_index.search(query, top_k * 2 if mode == 'hybrid' else top_k))
+    if mode in ('hybrid', 'semantic'):
+        rankings.append(st.session_state.vector_index.search(query, top_k * 2 if mode == 'hybrid' else top_k))
+    hits = fuse_rankings(rankings, top_k)
+    # Present passages in reading order so neighbouring chunks stay coherent
+    doc_order = {doc['name']: idx for idx, doc in enumerate(documents)}
+    hits.sort(key=lambda hit: (doc_order.get(hit[1]['doc_name'], 0), hit[1]['position']))
+    excerpts = defaultdict(list)
+    for _, chunk in hits:
+        location = f", page {chunk['page']}" if chunk['page'] else ""
+        excerpts[chunk['doc_name']].append(f"\n\n[Excerpt from {chunk['doc_name']}{location}]\n{chunk['text']}\n")
+    sections.extend("".join(doc_excerpts) for doc_excerpts in excerpts.values())
+    if not hits:
+        sections.append("\n\n(No passages in the text documents matched this question.)\n")
+    return sections
+
+
+def format_document_section(idx: int, doc: Dict) -> str:
+    """Render one document as a numbered section of the combined context"""
+    return f"\n\n{'='*60}\nDOCUMENT {idx}: {doc['name']} (Type: {doc['type']})\n{'='*60}\n\n{doc['content']}\n"
+
+
 def combine_documents(documents: List[Dict]) -> str:
     """Combine multiple documents into a single string with clear separation"""
     if not documents:
         return None
-    
-    combined = ""
-    for idx, doc in enumerate(documents, 1):
-        combined += f"\n\n{'='*60}\n"
-        combined += f"DOCUMENT {idx}: {doc['name']} (Type: {doc['type']})\n"
-        combined += f"{'='*60}\n\n"
-        combined += doc['content']
-        combined += "\n"
-    
-    return combined
+    return "".join(format_document_section(idx, doc) for idx, doc in enumerate(documents, 1))
+
+
+def unique_var_name(var_name: str, taken) -> str:
+    """var_name, or var_name_2, var_name_3, ... when it is already taken"""
+    candidate, suffix = var_name, 2
+    while candidate in taken:
+        candidate, suffix = f"{var_name}_{suffix}", suffix + 1
+    return candidate
+
+
+def build_document_record(content: str, name: str, file_type: str, df, meta: Dict, taken_names=()) -> tuple[Dict, Dict]:
+    """Turn a load_document result into a document dict and its named dataframes
+    Variable names already used by other uploads (data.csv next to data.tsv) get a numeric
+    suffix, and the summary in content is updated to match.
+    """
+    frames = {}
+    if df is not None:
+        # Store dataframes with clean variable names (one per workbook sheet)
+        if isinstance(df, dict):
+            var_names = dict(zip(meta['sheet_names'], get_sheet_var_names(name, meta['sheet_names'])))
+            frames = {var_names[sheet]: frame for sheet, frame in df.items()}
+        else:
+            frames = {get_var_name(name): df}
+        taken = set(taken_names)
+        for var_name in list(frames):
+            unique = unique_var_name(var_name, taken)
+            taken.add(unique)
+            if unique != var_name:
+                frames[unique] = frames.pop(var_name)
+                content = content.replace(f"DataFrame variable name: {var_name}\n", f"DataFrame variable name: {unique}\n", 1)
+
+    doc_dict = {"name": name, "content": content, "type": file_type,
+                "fingerprint": hashlib.sha256(content.encode()).hexdigest()}
+    if 'page_offsets' in meta:
+        doc_dict['page_offsets'] = meta['page_offsets']
+    if 'rows_per_sec' in meta:
+        doc_dict['ingest'] = meta
+    if 'sheet_seconds' in meta:
+        doc_dict['sheet_seconds'] = meta['sheet_seconds']
+        doc_dict['sheet_errors'] = meta['sheet_errors']
+    if 'memory_before' in meta:
+        doc_dict['footprint'] = (meta['memory_before'], meta['memory_after'])
+
+    if df is not None:
+        if isinstance(df, dict):
+            doc_dict['sheets'] = list(df)
+        doc_dict['dataframes'] = list(frames)
+    else:
+        doc_dict['stats'] = get_document_stats(content)
+    return doc_dict, frames
+
+
+def sync_document_registry(upload_keys: List[str]) -> List[str]:
+    """Diff the uploaded set against the document registry
+    Finished uploads are registered, removed ones dropped, and nothing else is touched:
+    when files are only appended, combined_content is extended with just their sections.
+    Returns: error messages for uploads that failed to parse
+    """
+    registry = st.session_state.doc_registry
+    jobs = st.session_state.ingest_jobs
+    if st.session_state.bm25_index is None:
+        st.session_state.bm25_index = BM25Index()
+        st.session_state.vector_index = VectorIndex()
+
+    removed = [key for key in registry if key not in upload_keys]
+    for key in removed:
+        # Each upload owns its (de-duplicated) variable names, so this never drops another file's frame
+        for var_name in registry.pop(key).get('frames', {}):
+            st.session_state.dataframes.pop(var_name, None)
+        st.session_state.bm25_index.remove_document(key)
+        st.session_state.vector_index.remove_document(key)
+    for key in list(jobs):
+        if key not in upload_keys:
+            jobs.pop(key)["future"].cancel()
+
+    added = []
+    for key in upload_keys:
+        if key in registry or key not in jobs or not jobs[key]["future"].done():
+            continue
+        content, name, file_type, df, meta = jobs.pop(key)["future"].result()
+        if not content:
+            registry[key] = {'error': meta.get('error')}
+            continue
+        doc_dict, frames = build_document_record(content, name, file_type, df, meta, st.session_state.dataframes)
+        registry[key] = {'doc': doc_dict, 'frames': frames}
+        st.session_state.dataframes.update(frames)
+        if file_type == 'text':
+            st.session_state.bm25_index.add_document(key, name, meta['chunks'])
+            st.session_state.vector_index.add_document(key, name, meta['chunks'], meta['chunk_vectors'])
+        added.append(key)
+    pin_spill_files(st.session_state.dataframes)
+
+    if removed or added:
+        ready_keys = [key for key in upload_keys if 'doc' in registry.get(key, {})]
+        previous_keys = st.session_state.document_keys
+        if not removed and ready_keys[:len(previous_keys)] == previous_keys:
+            new_sections = "".join(
+                format_document_section(idx, registry[key]['doc'])
+                for idx, key in enumerate(ready_keys[len(previous_keys):], len(previous_keys) + 1)
+            )
+            st.session_state.combined_content = (st.session_state.combined_content or "") + new_sections
+        else:
+            # Numbering changed; re-join the already parsed documents
+            st.session_state.combined_content = combine_documents([registry[key]['doc'] for key in ready_keys])
+        st.session_state.documents = [registry[key]['doc'] for key in ready_keys]
+        st.session_state.document_keys = ready_keys
+
+    return [registry[key]['error'] for key in upload_keys if registry.get(key, {}).get('error')]
+
+
+def render_ingest_progress(upload_keys: List[str]):
+    """Progress of the uploads still parsing, run as a fragment that refreshes itself while they do
+    As soon as one finishes, the whole app reruns so the file appears (and chat unlocks).
+    """
+    jobs = st.session_state.ingest_jobs
+    pending_jobs = [jobs[key] for key in upload_keys if key in jobs]
+    if any(job["future"].done() for job in pending_jobs):
+        st.rerun()
+    if pending_jobs:
+        st.markdown(f"#### ⏳ Parsing {len(pending_jobs)} of {len(upload_keys)} file(s)")
+        for job in pending_jobs:
+            elapsed = time.perf_counter() - job["started"]
+            if job["progress"]:
+                done, total = job["progress"]
+                st.progress(done / total, text=f"📄 {job['name']}: page {done}/{total} ({elapsed:.0f}s)")
+            else:
+                st.caption(f"⏳ {job['name']} ({elapsed:.0f}s)")
+
+
+def parse_assistant_message(content: str) -> Dict:
+    """Split an assistant reply once into display text, ```python blocks and the plots among them
+    Returns: {'display', 'code_blocks', 'plot_blocks': [{'code', 'library'}]}
+    """
+    display_lines, code_blocks, current_code = [], [], []
+    in_code_block = False
+    for line in content.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('```python'):
+            in_code_block = True
+            current_code = []
+        elif stripped == '```' and in_code_block:
+            in_code_block = False
+            if current_code:
+                code_blocks.append('\n'.join(current_code))
+        elif in_code_block:
+            current_code.append(line)
+        else:
+            display_lines.append(line)
+    plot_blocks = []
+    for code in code_blocks:
+        library = detect_plot_library(code)
+        if library:
+            plot_blocks.append({'code': code, 'library': library})
+    return {'display': '\n'.join(display_lines).strip(), 'code_blocks': code_blocks, 'plot_blocks': plot_blocks}
 
 
-def generate_plot_from_code(code: str, dataframes: Dict[str, pd.DataFrame], width: int = 10, height: int = 6) -> Optional[plt.Figure]:
-    """Execute plotting code safely and return the figure"""
+def parsed_message(message: Dict) -> Dict:
+    """A message's parse, computed on first use for messages saved before parsing existed"""
+    if 'parsed' not in message:
+        message['parsed'] = parse_assistant_message(message['content'])
+    return message['parsed']
+
+
+@st.cache_resource(show_spinner=False)
+def get_plot_worker_pool() -> WorkerPool:
+    """Process-wide pool of isolated plot workers, started on first use"""
+    return WorkerPool(PLOT_WORKERS, PLOT_MEMORY_LIMIT_MB)
+
+
+def plot_worker_frames(code: str, dataframes: Dict, fingerprints: Dict) -> Dict:
+    """Dataframes a plot block needs, as spill file paths where possible so workers map them from disk"""
+    frames = {}
+    for name in plot_frame_names(code, dataframes):
+        df = dataframes[name]
+        if hasattr(df, 'resolve'):
+            # Lazy workbook sheets are parsed and spilled the first time a plot reads them
+            df = df.resolve()
+        if not hasattr(df, 'path'):
+            if name not in fingerprints:
+                fingerprints[name] = frame_fingerprint(df)
+            # Spill resident frames once (keyed by content) instead of pickling them for every block
+            df = spill_dataframe(df, spill_path(f"plot-{fingerprints[name][:32]}"))
+        frames[name] = df.path if hasattr(df, 'path') else df
+    return frames
+
+
+def render_plot_isolated(code: str, dataframes: Dict, width: int, height: int, fingerprints: Dict,
+                         timeout_seconds: float = PLOT_TIMEOUT_SECONDS, export_format: str = None, downsample: bool = True) -> Dict:
+    """render_plot in an isolated worker; the Plotly figure is rebuilt from its JSON spec
+    Timeouts and worker crashes come back as an error entry.
+    """
+    start = time.perf_counter()
     try:
-        # Create a safe namespace with pandas, matplotlib, plotly, and dataframes
-        namespace = {
-            'pd': pd,
-            'plt': plt,
-            'px': px,
-            'go': go,
-            'sns': sns,
-            **dataframes  # Add all dataframes to namespace
-        }
-        
-        # If there's only one dataframe, also create a 'df' alias
-        if len(dataframes) == 1:
-            namespace['df'] = list(dataframes.values())[0]
-        
-        # Modify code to use custom figure size if plt.figure() is in the code
-        if 'plt.figure(' in code and 'figsize' not in code:
-            code = code.replace('plt.figure()', f'plt.figure(figsize=({width}, {height}))')
-        elif 'plt.figure(' not in code and ('plt.' in code or 'sns.' in code):
-            # If no plt.figure() but using matplotlib/seaborn, add it at the beginning
-            code = f'plt.figure(figsize=({width}, {height}))\n' + code
-        
-        # Execute the code
-        exec(code, namespace)
-        
-        # Return the current figure if using matplotlib
-        if plt.get_fignums():
-            return plt.gcf()
-        
-        return None
-    
-    except Exception as e:
-        st.error(f"Error generating plot: {str(e)}")
+        request = (code, plot_worker_frames(code, dataframes, fingerprints), width, height, export_format, downsample)
+    except OSError as e:
+        return {'kind': None, 'exports': {}, 'error': f"Could not load plot data: {e}", 'error_type': type(e).__name__,
+                'exec_seconds': time.perf_counter() - start, 'isolated': True}
+    try:
+        entry = get_plot_worker_pool().run('plot', request, timeout_seconds)
+    except (TimeoutError, ChildProcessError) as e:
+        entry = {'kind': None, 'exports': {}, 'error': f"Plot code failed: {e}", 'exec_seconds': time.perf_counter() - start}
+    if entry.get('figure_json'):
+        entry['figure'] = pio.from_json(entry.pop('figure_json'))
+    entry['isolated'] = True
+    return entry
+
+
+def frame_fingerprint(df) -> str:
+    """Content fingerprint of a resident or spilled dataframe"""
+    # Spill files and cached workbooks are content-addressed, so their path identifies the data without loading it
+    if hasattr(df, 'source_path'):
+        return f"{df.source_path}#{df.sheet_name}"
+    return df.path if hasattr(df, 'path') else dataframe_fingerprint(df)
+
+
+def plot_frame_names(code: str, dataframes: Dict) -> List[str]:
+    """Names of the dataframes a plot block reads (the only one, when there is just one)"""
+    return list(dataframes) if len(dataframes) == 1 else [name for name in dataframes if name in code]
+
+
+def plot_cache_key(code: str, dataframes: Dict, width: int, height: int, fingerprints: Dict, downsample: bool = True) -> str:
+    """Key a rendered plot by its code, the data it reads, its size and whether it was downsampled
+    fingerprints memoizes frame fingerprints by name for the current rerun.
+    """
+    digest = hashlib.sha256(code.encode())
+    for name in sorted(plot_frame_names(code, dataframes)):
+        if name not in fingerprints:
+            fingerprints[name] = frame_fingerprint(dataframes[name])
+        digest.update(f"|{name}={fingerprints[name]}".encode())
+    digest.update(f"|{width}x{height}|{downsample}".encode())
+    return digest.hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def get_plot_cache() -> Dict:
+    """Process-wide LRU of rendered plots, bounded by PLOT_CACHE_MAX_BYTES"""
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "bytes": 0}
+
+
+def plot_entry_size(entry: Dict) -> int:
+    """Approximate memory held by a rendered plot"""
+    return (len(entry.get('image') or b'') + len(entry.get('figure_pickle') or b'')
+            + sum(len(data) for data in entry['exports'].values()))
+
+
+def get_rendered_plot(code: str, dataframes: Dict, width: int, height: int, fingerprints: Dict,
+                      isolated: bool = False, timeout_seconds: float = PLOT_TIMEOUT_SECONDS, downsample: bool = True) -> Dict:
+    """Rendered plot from the cache, executing the code only on a miss
+    Only successful renders and errors in the code itself are cached. Anything else (a timeout,
+    a worker crash, MemoryError, a missing spill file) is retried on the next rerun.
+    """
+    key = plot_cache_key(code, dataframes, width, height, fingerprints, downsample)
+    cache = get_plot_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is not None:
+            cache["entries"].move_to_end(key)
+            return entry
+    if isolated:
+        entry = render_plot_isolated(code, dataframes, width, height, fingerprints, timeout_seconds, downsample=downsample)
+    else:
+        start = time.perf_counter()
+        try:
+            entry = render_plot(code, resolve_dataframes(dataframes, code), width, height, downsample=downsample)
+        except OSError as e:
+            entry = {'kind': None, 'exports': {}, 'error': f"Could not load plot data: {e}", 'error_type': type(e).__name__}
+        entry['exec_seconds'] = time.perf_counter() - start
+    if entry['error'] and entry.get('error_type') not in CACHEABLE_PLOT_ERRORS:
+        return entry
+    with cache["lock"]:
+        if key not in cache["entries"]:
+            cache["entries"][key] = entry
+            cache["bytes"] += plot_entry_size(entry)
+            while cache["bytes"] > PLOT_CACHE_MAX_BYTES and len(cache["entries"]) > 1:
+                _, evicted = cache["entries"].popitem(last=False)
+                cache["bytes"] -= plot_entry_size(evicted)
+    return entry
+
+
+def get_plot_export(entry: Dict, code: str, dataframes: Dict, width: int, height: int, export_format: str,
+                    fingerprints: Dict, isolated: bool = False, timeout_seconds: float = PLOT_TIMEOUT_SECONDS,
+                    downsample: bool = True) -> bytes:
+    """Download bytes for a rendered plot, encoded on first request and then kept with the entry
+    Runs when a download button is clicked (on Streamlit's download thread), never during a rerun.
+    Figures are redrawn from the cached render (matplotlib ones from their pickle, which needs no
+    pyplot state); the code is only re-run for figures that could not be pickled.
+    """
+    cache = get_plot_cache()
+    with cache["lock"]:
+        if export_format in entry['exports']:
+            return entry['exports'][export_format]
+    if entry.get('figure') is not None:
+        data = save_plot_to_bytes(entry['figure'], export_format, is_plotly=True).getvalue()
+    elif entry.get('figure_pickle'):
+        data = save_plot_to_bytes(pickle.loads(entry['figure_pickle']), export_format).getvalue()
+    else:
+        if isolated:
+            exported = render_plot_isolated(code, dataframes, width, height, fingerprints, timeout_seconds, export_format, downsample)
+        else:
+            exported = render_plot(code, resolve_dataframes(dataframes, code), width, height, export_format, downsample)
+        if exported['error']:
+            raise RuntimeError(exported['error'])
+        data = exported['exports'][export_format]
+    with cache["lock"]:
+        if export_format not in entry['exports']:
+            entry['exports'][export_format] = data
+            cache["bytes"] += len(data)
+    return data
+
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoder(model: str):
+    """tiktoken encoding for a model, or None when tiktoken is not installed"""
+    if tiktoken is None:
         return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
 
+def count_tokens(text: str, model: str = DEFAULT_CHAT_MODEL) -> int:
+    """Token count of text for a model (estimated from its length without tiktoken)"""
+    encoder = get_token_encoder(model)
+    if encoder is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
 
-def save_plot_to_bytes(fig, format: str = 'png', is_plotly: bool = False) -> io.BytesIO:
-    """Save a plot to bytes buffer for download"""
-    buf = io.BytesIO()
-    
-    if is_plotly:
-        # For Plotly figures
-        if format == 'html':
-            fig.write_html(buf)
-        elif format == 'png':
-            fig.write_image(buf, format='png')
-        elif format == 'svg':
-            fig.write_image(buf, format='svg')
-        elif format == 'pdf':
-            fig.write_image(buf, format='pdf')
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = DEFAULT_CHAT_MODEL) -> str:
+    """Trim text to at most max_tokens, keeping its head (section header included) and a little of its tail"""
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER, model)
+    if budget <= 0:
+        return ""
+    head_tokens = budget * 3 // 4
+    tail_tokens = budget - head_tokens
+    encoder = get_token_encoder(model)
+    if encoder is None:
+        head, tail = text[:head_tokens * CHARS_PER_TOKEN], text[len(text) - tail_tokens * CHARS_PER_TOKEN:]
     else:
-        # For Matplotlib figures
-        fig.savefig(buf, format=format, dpi=300, bbox_inches='tight')
-    
-    buf.seek(0)
-    return buf
+        tokens = encoder.encode(text, disallowed_special=())
+        head, tail = encoder.decode(tokens[:head_tokens]), encoder.decode(tokens[len(tokens) - tail_tokens:])
+    return head + TRUNCATION_MARKER + tail
+
+
+def pack_sections(sections: List[str], budget: int, model: str = DEFAULT_CHAT_MODEL) -> tuple[List[str], Dict]:
+    """Fit document sections into a token budget with water-filling quotas
+    Sections smaller than an equal share are kept whole and their unused share is
+    redistributed, so only the largest sections are trimmed, and all to the same size.
+    """
+    sizes = [count_tokens(section, model) for section in sections]
+    quotas = [0] * len(sections)
+    remaining = max(budget, 0)
+    for rank, idx in enumerate(sorted(range(len(sections)), key=sizes.__getitem__)):
+        quotas[idx] = min(sizes[idx], remaining // (len(sections) - rank))
+        remaining -= quotas[idx]
+    packed = [
+        section if quota >= size else truncate_to_tokens(section, quota, model)
+        for section, size, quota in zip(sections, sizes, quotas)
+    ]
+    stats = {
+        "sections": len(sections),
+        "trimmed_sections": sum(quota < size for size, quota in zip(sizes, quotas)),
+        "omitted_sections": sum(quota == 0 and size > 0 for size, quota in zip(sizes, quotas)),
+        "original_tokens": sum(sizes),
+        "document_tokens": sum(count_tokens(section, model) for section in packed),
+        "document_budget": max(budget, 0),
+    }
+    return packed, stats
+
+
+class OpenAIBackend:
+    """LLM backend for the OpenAI API or any OpenAI-compatible server (base_url)
+    Backends expose `client`, a long-lived OpenAI-style sync client, and `async_client()`,
+    which makes a fresh async client for the current event loop.
+    """
+
+    def __init__(self, api_key: str, base_url: str = None, timeout_seconds: float = REQUEST_TIMEOUT_SECONDS):
+        self.name = "openai"
+        # The SDK's own retries are disabled; call_with_retries applies the app's backoff policy
+        self.options = {"api_key": api_key, "base_url": base_url or None, "timeout": timeout_seconds, "max_retries": 0}
+        self.client = OpenAI(**self.options)
+
+    def async_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(**self.options)
+
+
+class MockBackend:
+    """Offline OpenAI-compatible stand-in for latency and throughput testing without network or spend
+    Replies after a fixed latency at a fixed token rate, with canned plot code when asked for a chart.
+    """
+
+    def __init__(self, latency_seconds: float = MOCK_LATENCY_SECONDS, tokens_per_second: float = MOCK_TOKENS_PER_SECOND):
+        self.name = "mock"
+        self.latency_seconds = latency_seconds
+        self.tokens_per_second = tokens_per_second
+        self.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.create)))
+
+    def async_client(self):
+        backend = self
+
+        class AsyncMockClient:
+            chat = SimpleNamespace(completions=SimpleNamespace(create=backend.acreate))
 
+            async def __aenter__(self):
+                return self
 
-def get_ai_response(messages: List[Dict], api_key: str, document_content: str, num_documents: int = 1, has_data_files: bool = False, dataframe_names: List[str] = None) -> str:
-    """Get response from OpenAI API with document context"""
+            async def __aexit__(self, *exc_info):
+                return False
+
+        return AsyncMockClient()
+
+    def reply(self, messages: List[Dict], max_tokens: int) -> List[str]:
+        """Canned answer to the last question, as a list of token-sized pieces"""
+        question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        names = re.findall(r"available as both '(\w+)'|available as: ([\w, ]+)", system)
+        df_name = next((single or multiple.split(",")[0].strip() for single, multiple in names), None)
+        if df_name and re.search(r"\b(plot|chart|graph|visuali[sz]e|histogram)", question, re.IGNORECASE):
+            text = f"""Here is a quick look at the first numeric column of {df_name}.
+
+```python
+import matplotlib.pyplot as plt
+
+plt.figure(figsize=(10, 6))
+{df_name}.select_dtypes('number').iloc[:, 0].plot(kind='hist', bins=30)
+plt.title('Distribution')
+plt.xlabel('Value')
+plt.ylabel('Count')
+plt.tight_layout()
+```"""
+        else:
+            filler = " ".join(["This is a mock answer generated offline."] * (MOCK_ANSWER_TOKENS // 8))
+            text = f"(mock) You asked: {question[:200]}\n\n{filler}"
+        pieces = re.findall(r"\S+\s*|\s+", text)
+        return pieces[:max_tokens] if max_tokens else pieces
+
+    def _usage(self, messages: List[Dict], pieces: List[str]) -> SimpleNamespace:
+        prompt_tokens = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+        return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(pieces), total_tokens=prompt_tokens + len(pieces))
+
+    def _response(self, messages, pieces):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(pieces)))],
+                               usage=self._usage(messages, pieces))
+
+    def _chunk(self, content=None, usage=None):
+        choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+        return SimpleNamespace(choices=choices, usage=usage)
+
+    def create(self, model: str, messages: List[Dict], max_tokens: int = None, stream: bool = False, **kwargs):
+        pieces = self.reply(messages, max_tokens)
+        time.sleep(self.latency_seconds)
+        if not stream:
+            time.sleep(len(pieces) / self.tokens_per_second)
+            return self._response(messages, pieces)
+
+        def events():
+            for piece in pieces:
+                time.sleep(1 / self.tokens_per_second)
+                yield self._chunk(piece)
+            if (kwargs.get("stream_options") or {}).get("include_usage"):
+                yield self._chunk(usage=self._usage(messages, pieces))
+        return events()
+
+    async def acreate(self, model: str, messages: List[Dict], max_tokens: int = None, **kwargs):
+        pieces = self.reply(messages, max_tokens)
+        await asyncio.sleep(self.latency_seconds + len(pieces) / self.tokens_per_second)
+        return self._response(messages, pieces)
+
+
+@st.cache_resource(show_spinner=False, max_entries=LLM_CLIENT_POOL_SIZE)
+def get_llm_backend(kind: str, api_key: str = None, base_url: str = None, timeout_seconds: float = REQUEST_TIMEOUT_SECONDS,
+                    mock_latency: float = MOCK_LATENCY_SECONDS, mock_tokens_per_second: float = MOCK_TOKENS_PER_SECOND):
+    """Process-wide backend per configuration, so each API key keeps its keep-alive connections and TLS sessions"""
+    if kind == "mock":
+        return MockBackend(mock_latency, mock_tokens_per_second)
+    return OpenAIBackend(api_key, base_url, timeout_seconds)
+
+
+def current_llm_backend(api_key: str):
+    """The backend selected in Model Settings"""
+    if st.session_state.llm_backend == "mock":
+        return get_llm_backend("mock", mock_latency=st.session_state.mock_latency,
+                               mock_tokens_per_second=st.session_state.mock_tokens_per_second)
+    return get_llm_backend("openai", api_key, st.session_state.llm_base_url, st.session_state.request_timeout)
+
+
+@st.cache_resource(show_spinner=False)
+def get_retry_stats() -> Dict:
+    """Process-wide request and retry counters"""
+    return {"lock": threading.Lock(), "requests": 0, "retries": 0, "failures": 0, "by_reason": Counter()}
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, timeouts, dropped connections and server errors are worth retrying"""
+    if isinstance(error, APIConnectionError):  # Includes timeouts
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code in RETRY_STATUS_CODES or error.status_code >= 500)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Full-jitter exponential backoff, or the server's Retry-After when it asks for longer"""
+    delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+    response = getattr(error, "response", None)
     try:
-        client = OpenAI(api_key=api_key)
+        retry_after = float(response.headers.get("retry-after")) if response is not None else 0.0
+    except (TypeError, ValueError):
+        retry_after = 0.0
+    return max(delay, min(retry_after, RETRY_MAX_SECONDS))
+
+
+def record_attempt_failure(error: Exception, attempt: int, max_retries: int, stats: Dict = None) -> Optional[float]:
+    """Count a failed attempt; returns the backoff before the next one, or None to give up"""
+    counters = get_retry_stats()
+    if attempt == max_retries or not is_retryable(error):
+        with counters["lock"]:
+            counters["failures"] += 1
+        return None
+    reason = str(getattr(error, "status_code", None) or type(error).__name__)
+    with counters["lock"]:
+        counters["retries"] += 1
+        counters["by_reason"][reason] += 1
+    if stats is not None:
+        stats["retries"] = stats.get("retries", 0) + 1
+    return retry_delay(error, attempt)
+
+
+def record_request():
+    """Count one logical API request (however many attempts it takes)"""
+    counters = get_retry_stats()
+    with counters["lock"]:
+        counters["requests"] += 1
+
+
+def call_with_retries(request, max_retries: int = REQUEST_MAX_RETRIES, stats: Dict = None):
+    """Run request() and retry transient API failures with backoff, counting retries
+    per call (in stats, when given) and process-wide.
+    """
+    record_request()
+    for attempt in range(max_retries + 1):
+        try:
+            return request()
+        except Exception as e:
+            delay = record_attempt_failure(e, attempt, max_retries, stats)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+
+async def acall_with_retries(request, max_retries: int = REQUEST_MAX_RETRIES, stats: Dict = None):
+    """Async counterpart of call_with_retries for coroutine-returning requests"""
+    record_request()
+    for attempt in range(max_retries + 1):
+        try:
+            return await request()
+        except Exception as e:
+            delay = record_attempt_failure(e, attempt, max_retries, stats)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+
+
+def history_digest(messages: List[Dict]) -> str:
+    """Fingerprint of a run of chat messages, to tell whether a summary still describes them"""
+    hasher = hashlib.sha1()
+    for message in messages:
+        hasher.update(f"{message['role']}\0{message['content']}\0".encode())
+    return hasher.hexdigest()
+
+
+def summarize_history(previous_summary: str, new_messages: List[Dict], api_key: str, model: str = DEFAULT_CHAT_MODEL,
+                      stats: Dict = None) -> str:
+    """Fold newly aged-out chat messages into the running summary
+    With stats, the call's retries and token usage are recorded in it.
+    """
+    client = current_llm_backend(api_key).client
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in new_messages)
+    response = call_with_retries(lambda: client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": "You maintain a running summary of a conversation about uploaded documents. "
+                                          "Merge the new messages into the existing summary. Keep facts, figures, names, "
+                                          "decisions, open questions and any code or plots discussed. Be concise."},
+            {"role": "user", "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"},
+        ],
+        temperature=0.2,
+        max_tokens=SUMMARY_MAX_TOKENS
+    ), st.session_state.request_max_retries, stats)
+    if stats is not None:
+        record_usage(stats, response.usage)
+    return response.choices[0].message.content
+
+
+def compact_history(messages: List[Dict], api_key: str, model: str = DEFAULT_CHAT_MODEL,
+                    recent_turns: int = HISTORY_RECENT_TURNS, max_tokens: int = HISTORY_MAX_TOKENS) -> tuple[List[Dict], Dict]:
+    """Chat history to send: a running summary of older turns plus the last recent_turns verbatim
+    The summary is cached in session state and only extended with the messages that aged out
+    since it was written. Aged-out turns are folded in batches: they stay verbatim until
+    HISTORY_SUMMARY_BATCH_TURNS of them have built up, so most questions make no summary call.
+    Verbatim turns are also dropped into the summary, oldest first, while they exceed
+    max_tokens (the latest question is always kept).
+    The summary call's latency and token use are recorded in the returned stats.
+    """
+    user_positions = [idx for idx, m in enumerate(messages) if m["role"] == "user"]
+    split = user_positions[-recent_turns] if len(user_positions) >= recent_turns else 0
+    sizes = [count_tokens(m["content"], model) + MESSAGE_OVERHEAD_TOKENS for m in messages]
+    while split < len(messages) - 1 and sum(sizes[split:]) > max_tokens:
+        split += 1
+
+    summary = st.session_state.history_summary
+    if summary is None or summary["covered"] > split or summary["digest"] != history_digest(messages[:summary["covered"]]):
+        summary = {"covered": 0, "digest": history_digest([]), "text": ""}
+    pending_turns = sum(summary["covered"] <= idx < split for idx in user_positions)
+    if pending_turns < HISTORY_SUMMARY_BATCH_TURNS and sum(sizes[summary["covered"]:]) <= max_tokens:
+        # Not a full batch yet and still within budget: keep the aged-out turns verbatim
+        split = summary["covered"]
+    older, recent = messages[:split], messages[split:]
+    stats = {"verbatim_messages": len(recent), "summarized_messages": len(older)}
+    if not older:
+        return recent, stats
+
+    if summary["covered"] < len(older):
+        summary_stats = {}
+        # Estimated from the folded messages and previous summary when the API reports no usage
+        prompt_estimate = sum(sizes[summary["covered"]:split]) + count_tokens(summary["text"], model)
+        start = time.perf_counter()
+        try:
+            text = summarize_history(summary["text"], older[summary["covered"]:], api_key, model, summary_stats)
+            summary = {"covered": len(older), "digest": history_digest(older), "text": text}
+            st.session_state.history_summary = summary
+            usage = summary_stats.get("usage") or {}
+            stats["summary_prompt_tokens"] = usage.get("prompt_tokens", prompt_estimate)
+            stats["summary_completion_tokens"] = usage.get("completion_tokens", count_tokens(text, model))
+        except Exception:
+            # Keep the last good summary; the uncovered turns are retried next time
+            stats["summary_stale"] = True
+        stats["summary_seconds"] = time.perf_counter() - start
+    summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['text'] or '(earlier turns omitted)'}"}
+    stats["summary_tokens"] = count_tokens(summary_message["content"], model)
+    return [summary_message] + recent, stats
+
+
+def record_usage(stats: Dict, usage):
+    """Copy token usage reported by the API into request stats"""
+    if usage is not None:
+        stats["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+
+def build_request_metrics(stats: Dict, response: str, submitted_at: float, model: str, backend: str, cached: bool = False) -> Dict:
+    """One flat, JSON-ready record of a question's latency and token use
+    Token counts come from the API's usage report when present, otherwise from count_tokens.
+    Cached answers made no request, so only their end-to-end latency is recorded. For map-reduce
+    answers, prompt/completion tokens and request time are the reduce call's; the map phase is
+    recorded separately.
+    """
+    if cached:
+        stats = {}
+    map_stats = stats.get("map_reduce") or {}
+    usage = stats.get("usage")
+    completion_tokens = usage["completion_tokens"] if usage else (0 if cached else count_tokens(response, model))
+    prompt_tokens = usage["prompt_tokens"] if usage else (0 if cached else stats.get("prompt_tokens"))
+    request_seconds = stats.get("total_seconds")
+    ttft_seconds = stats.get("ttft_seconds")
+    generation_seconds = request_seconds - (ttft_seconds or 0.0) if request_seconds is not None else None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model,
+        "backend": backend,
+        "cached": cached,
+        "map_reduce": "map_reduce" in stats,
+        "queue_seconds": stats.get("queue_seconds"),
+        "map_seconds": map_stats.get("map_seconds"),
+        "map_prompt_tokens": map_stats.get("map_prompt_tokens"),
+        "map_completion_tokens": map_stats.get("map_completion_tokens"),
+        "summary_seconds": stats.get("summary_seconds"),
+        "summary_prompt_tokens": stats.get("summary_prompt_tokens"),
+        "summary_completion_tokens": stats.get("summary_completion_tokens"),
+        "ttft_seconds": ttft_seconds,
+        "request_seconds": request_seconds,
+        "latency_seconds": time.perf_counter() - submitted_at,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / generation_seconds if generation_seconds and completion_tokens else None,
+        "token_source": "api" if usage else "estimate",
+        "retries": stats.get("retries", 0),
+        "error": response.startswith("Error:"),
+    }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    """Seconds for display, or a dash when not measured"""
+    return f"{value:.3f}s" if value is not None else "–"
+
+
+def summarize_request_log(log: List[Dict]) -> Dict:
+    """Session aggregate over request metrics: counts, latency percentiles and token totals"""
+    def percentiles(field):
+        values = [m[field] for m in log if m.get(field) is not None and not m["cached"]]
+        return (float(np.percentile(values, 50)), float(np.percentile(values, 95))) if values else None
+
+    throughput = [m["tokens_per_second"] for m in log if m.get("tokens_per_second")]
+    return {
+        "requests": len(log),
+        "cached": sum(m["cached"] for m in log),
+        "errors": sum(m["error"] for m in log),
+        "ttft": percentiles("ttft_seconds"),
+        "latency": percentiles("latency_seconds"),
+        "queue": percentiles("queue_seconds"),
+        "prompt_tokens": sum(m["prompt_tokens"] or 0 for m in log),
+        "completion_tokens": sum(m["completion_tokens"] or 0 for m in log),
+        "map_tokens": sum((m.get("map_prompt_tokens") or 0) + (m.get("map_completion_tokens") or 0) for m in log),
+        "summary_calls": sum(m.get("summary_seconds") is not None for m in log),
+        "summary_tokens": sum((m.get("summary_prompt_tokens") or 0) + (m.get("summary_completion_tokens") or 0) for m in log),
+        "tokens_per_second": sum(throughput) / len(throughput) if throughput else None,
+    }
+
+
+def get_ai_response(messages: List[Dict], api_key: str, document_content, num_documents: int = 1, has_data_files: bool = False,
+                    dataframe_names: List[str] = None, model: str = DEFAULT_CHAT_MODEL, max_tokens: int = RESPONSE_MAX_TOKENS,
+                    on_token=None, submitted_at: float = None) -> tuple[str, Dict]:
+    """Get response from OpenAI API with document context packed into the model's window
+    document_content is a list of per-document sections (or one string).
+    With on_token, the reply is streamed and each text delta is passed to it as it arrives.
+    submitted_at (a time.perf_counter() value) is when the question was asked, for queue time.
+    Returns the complete reply and the token and timing accounting for the request.
+    """
+    context_stats = {}
+    try:
+        client = current_llm_backend(api_key).client
 
         # Create system message with document context
         doc_text = "documents" if num_documents > 1 else "document"
@@ -1392,32 +3256,294 @@ fig = px.bar(df, x='column1', y='column2', title='Title Here')
 fig.show()
 ```"""
         
-        system_message = {
-            "role": "system",
-            "content": f"""You are a helpful AI assistant. You have access to the following {doc_text}:
+        system_template = f"""You are a helpful AI assistant. You have access to the following {doc_text}:
 
 ---DOCUMENTS START---
-{document_content}
+{{documents}}
 ---DOCUMENTS END---
 
 Please answer questions based on these {doc_text}. When referencing information, mention which document it comes from if multiple documents are provided. If the information is not in the {doc_text}, mention that and provide a helpful response anyway.{data_instructions}"""
-        }
+
+        # Only role and content go to the API; messages also carry display metadata
+        chat_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+
+        # Whatever the window leaves after the reply, instructions and chat history goes to the documents
+        context_window = CHAT_MODELS.get(model, CHAT_MODELS[DEFAULT_CHAT_MODEL])
+        fixed_tokens = count_tokens(system_template.replace("{documents}", ""), model) + sum(
+            count_tokens(m["content"], model) + MESSAGE_OVERHEAD_TOKENS for m in chat_messages
+        ) + MESSAGE_OVERHEAD_TOKENS
+        # A reply reservation close to the window size would leave no room for the documents at all
+        requested_max_tokens = max_tokens
+        reply_ceiling = context_window - fixed_tokens - TOKEN_SAFETY_MARGIN - MIN_DOCUMENT_TOKENS
+        max_tokens = max(min(max_tokens, reply_ceiling), MIN_RESPONSE_TOKENS)
+        document_budget = context_window - max_tokens - fixed_tokens - TOKEN_SAFETY_MARGIN
+        sections = [document_content] if isinstance(document_content, str) else list(document_content or [])
+        packed, context_stats = pack_sections(sections, document_budget, model)
+        context_stats.update({
+            "model": model,
+            "context_window": context_window,
+            "max_tokens": max_tokens,
+            "requested_max_tokens": requested_max_tokens,
+            "prompt_tokens": fixed_tokens + context_stats["document_tokens"],
+            "tokenizer": "tiktoken" if get_token_encoder(model) is not None else "estimate",
+        })
+
+        system_message = {"role": "system", "content": system_template.replace("{documents}", "".join(packed))}
 
         # Combine system message with user messages
-        full_messages = [system_message] + messages
+        full_messages = [system_message] + chat_messages
 
         # Call OpenAI API
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=full_messages,
-            temperature=0.7,
-            max_tokens=1000
+        request_start = time.perf_counter()
+        if submitted_at is not None:
+            context_stats["queue_seconds"] = request_start - submitted_at
+        stream_options = {"stream_options": {"include_usage": True}} if on_token is not None else {}
+
+        def create(**extra):
+            return call_with_retries(lambda: client.chat.completions.create(
+                model=model,
+                messages=full_messages,
+                temperature=0.7,
+                max_tokens=max_tokens,
+                stream=on_token is not None,
+                **extra
+            ), st.session_state.request_max_retries, context_stats)
+
+        try:
+            response = create(**stream_options)
+        except APIStatusError as e:
+            # Some OpenAI-compatible servers reject stream_options; stream without the usage report instead
+            if not stream_options or e.status_code != 400:
+                raise
+            response = create()
+        if on_token is None:
+            context_stats["total_seconds"] = time.perf_counter() - request_start
+            record_usage(context_stats, getattr(response, "usage", None))
+            return response.choices[0].message.content, context_stats
+
+        parts = []
+        for event in response:
+            delta = event.choices[0].delta.content if event.choices else None
+            if delta:
+                if not parts:
+                    context_stats["ttft_seconds"] = time.perf_counter() - request_start
+                parts.append(delta)
+                on_token(delta)
+            # With include_usage, the last event carries the token counts
+            record_usage(context_stats, getattr(event, "usage", None))
+        context_stats["total_seconds"] = time.perf_counter() - request_start
+        return "".join(parts), context_stats
+
+    except Exception as e:
+        return f"Error: {str(e)}", context_stats
+
+
+def build_map_shards(documents: List[Dict], shard_tokens: int = MAP_SHARD_TOKENS, model: str = DEFAULT_CHAT_MODEL) -> List[Dict]:
+    """Split the full document set into map-reduce shards of about shard_tokens each
+    Documents that fit are one shard; larger ones are cut at natural breaks, keeping page numbers.
+    """
+    shards = []
+    for idx, doc in enumerate(documents, 1):
+        section = format_document_section(idx, doc)
+        if count_tokens(section, model) <= shard_tokens:
+            shards.append({"label": doc['name'], "text": section})
+            continue
+        parts = chunk_text(doc['content'], doc.get('page_offsets'), shard_tokens * CHARS_PER_TOKEN, CHUNK_OVERLAP_CHARS)
+        for part_idx, part in enumerate(parts, 1):
+            location = f", from page {part['page']}" if part['page'] else ""
+            label = f"{doc['name']}, part {part_idx}/{len(parts)}{location}"
+            shards.append({"label": label, "text": f"[{label}]\n{part['text']}"})
+    return shards
+
+
+async def _map_shard(client, semaphore: asyncio.Semaphore, shard: Dict, question: str,
+                     model: str, max_retries: int) -> tuple[str, float, Dict]:
+    """Answer the question from one shard; returns the partial answer, its latency and token usage"""
+    async with semaphore:
+        start = time.perf_counter()
+        response = await acall_with_retries(lambda: client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": f"""Answer the user's question using only this excerpt from {shard['label']}.
+Quote figures and names exactly and mention page numbers when shown. If the excerpt contains nothing relevant, reply exactly {NO_RELEVANT_INFO}.
+
+---EXCERPT START---
+{shard['text']}
+---EXCERPT END---"""},
+                {"role": "user", "content": question},
+            ],
+            temperature=0.2,
+            max_tokens=MAP_MAX_TOKENS
+        ), max_retries)
+        answer = response.choices[0].message.content or ""
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            tokens = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+        else:
+            tokens = {"prompt_tokens": count_tokens(shard['text'] + question, model), "completion_tokens": count_tokens(answer, model)}
+        return answer, time.perf_counter() - start, tokens
+
+
+async def _map_shards(backend, shards: List[Dict], question: str, model: str, max_retries: int, concurrency: int) -> list:
+    """Run every map call concurrently, at most `concurrency` at a time
+    The async client lives for one run: its connection pool is bound to this event loop.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    async with backend.async_client() as client:
+        return await asyncio.gather(
+            *(_map_shard(client, semaphore, shard, question, model, max_retries) for shard in shards),
+            return_exceptions=True
         )
 
-        return response.choices[0].message.content
 
+def map_reduce_answer(messages: List[Dict], api_key: str, documents: List[Dict], has_data_files: bool = False,
+                      dataframe_names: List[str] = None, model: str = DEFAULT_CHAT_MODEL, max_tokens: int = RESPONSE_MAX_TOKENS,
+                      on_token=None, submitted_at: float = None) -> tuple[str, Dict]:
+    """Answer over a document set of any size: ask each shard concurrently (map), then
+    combine the relevant partial answers with get_ai_response (reduce)
+    """
+    question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    shards = build_map_shards(documents, MAP_SHARD_TOKENS, model)
+    wall_start = time.perf_counter()
+    try:
+        results = asyncio.run(_map_shards(
+            current_llm_backend(api_key), shards, question, model,
+            st.session_state.request_max_retries, st.session_state.map_concurrency
+        ))
     except Exception as e:
-        return f"Error: {str(e)}"
+        return f"Error: {str(e)}", {}
+    map_seconds = time.perf_counter() - wall_start
+
+    partials, latencies, failed = [], [], 0
+    map_tokens = {"prompt_tokens": 0, "completion_tokens": 0}
+    for shard, result in zip(shards, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            continue
+        answer, latency, tokens = result
+        latencies.append(latency)
+        map_tokens["prompt_tokens"] += tokens["prompt_tokens"]
+        map_tokens["completion_tokens"] += tokens["completion_tokens"]
+        if answer.strip() and NO_RELEVANT_INFO not in answer:
+            partials.append(f"\n\n[Partial answer from {shard['label']}]\n{answer.strip()}\n")
+    if not latencies and shards:
+        return f"Error: all {len(shards)} map requests failed ({results[0]})", {}
+    relevant_shards = len(partials)
+    if not partials:
+        partials = ["\n\n(None of the documents contain information relevant to this question.)\n"]
+
+    # The reduce call's own queue time would include the whole map phase; queue time ends when mapping starts
+    response, stats = get_ai_response(
+        messages, api_key, partials, len(documents), has_data_files, dataframe_names, model, max_tokens, on_token
+    )
+    if submitted_at is not None:
+        stats["queue_seconds"] = wall_start - submitted_at
+    stats["map_reduce"] = {
+        "shards": len(shards),
+        "relevant_shards": relevant_shards,
+        "failed_shards": failed,
+        "map_seconds": map_seconds,
+        "wall_seconds": time.perf_counter() - wall_start,
+        "shard_seconds": latencies,
+        **{f"map_{field}": count for field, count in map_tokens.items()},
+    }
+    return response, stats
+
+
+def documents_fit_window(documents: List[Dict], model: str, max_tokens: int) -> bool:
+    """Whether the whole document set fits the model's window next to the reply"""
+    budget = CHAT_MODELS.get(model, CHAT_MODELS[DEFAULT_CHAT_MODEL]) - max_tokens - TOKEN_SAFETY_MARGIN
+    total = 0
+    for doc in documents:
+        total += count_tokens(doc['content'], model)
+        if total > budget:
+            return False
+    return True
+
+
+def response_cache_key(documents: List[Dict], messages: List[Dict], params: Dict) -> str:
+    """Key an answer by what it depends on: the document set, the conversation so far and the model settings
+    Messages are compared by role and whitespace-normalized text (questions also ignore case),
+    so trivially different retypes of a starter question still hit.
+    """
+    hasher = hashlib.sha256()
+    for doc in documents:
+        hasher.update(f"doc\0{doc['name']}\0{doc.get('fingerprint', '')}\0".encode())
+    for message in messages:
+        text = WHITESPACE_PATTERN.sub(" ", message["content"]).strip()
+        if message["role"] == "user":
+            text = text.casefold()
+        hasher.update(f"msg\0{message['role']}\0{text}\0".encode())
+    hasher.update(json.dumps(params, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def response_cache_get(key: str) -> Optional[Dict]:
+    """Cached {'response', 'stats', 'created'} for a key, unless missing or older than the TTL"""
+    path = os.path.join(RESPONSE_CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        if time.time() - entry["created"] > RESPONSE_CACHE_TTL_SECONDS:
+            os.remove(path)
+            return None
+        os.utime(path)  # Mark as recently used for LRU eviction
+        return entry
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def response_cache_put(key: str, response: str, stats: Dict):
+    """Store an answer atomically, then evict expired and least recently used entries"""
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=RESPONSE_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"response": response, "stats": stats, "created": time.time()}, f)
+        os.replace(tmp_path, os.path.join(RESPONSE_CACHE_DIR, f"{key}.json"))
+    except (OSError, TypeError, ValueError):
+        return
+    evict_response_cache()
+
+
+def evict_response_cache(max_entries: int = None):
+    """Drop expired answers, then the least recently used ones beyond max_entries"""
+    max_entries = RESPONSE_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    now = time.time()
+    entries = []
+    try:
+        with os.scandir(RESPONSE_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+    except OSError:
+        return
+    entries.sort(reverse=True)
+    for rank, (mtime, path) in enumerate(entries):
+        if rank >= max_entries or now - mtime > RESPONSE_CACHE_TTL_SECONDS:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def make_stream_writer(placeholder):
+    """on_token callback that grows an assistant bubble in place, redrawing at most every STREAM_RENDER_SECONDS"""
+    parts = []
+    last_draw = [0.0]
+
+    def write(delta: str):
+        parts.append(delta)
+        now = time.perf_counter()
+        if now - last_draw[0] >= STREAM_RENDER_SECONDS:
+            last_draw[0] = now
+            display_content = STREAM_CODE_PATTERN.sub("", "".join(parts)).strip()
+            placeholder.markdown(
+                f'<div class="chat-message assistant-message"><strong>🤖 AI:</strong><br>{display_content} ▌</div>',
+                unsafe_allow_html=True
+            )
+
+    return write
 
 
 def save_conversation():
@@ -1438,6 +3564,7 @@ def load_conversation(index: int):
     if 0 <= index < len(st.session_state.conversation_history):
         conversation = st.session_state.conversation_history[index]
         st.session_state.messages = conversation["messages"].copy()
+        st.session_state.history_summary = None
         st.session_state.current_conversation_index = index
         st.rerun()
 
@@ -1445,6 +3572,7 @@ def load_conversation(index: int):
 def clear_current_chat():
     """Clear current chat messages"""
     st.session_state.messages = []
+    st.session_state.history_summary = None
     st.rerun()
 
 
@@ -1475,9 +3603,186 @@ with st.sidebar:
             st.session_state.api_key = api_key_input
             st.rerun()
 
+    with st.expander("🧠 Model Settings"):
+        st.session_state.llm_backend = st.selectbox(
+            "LLM Backend",
+            options=LLM_BACKENDS,
+            index=LLM_BACKENDS.index(st.session_state.llm_backend),
+            help="'mock' answers offline with canned replies, for latency and throughput testing without network or spend"
+        )
+        if st.session_state.llm_backend == 'mock':
+            st.session_state.mock_latency = st.number_input(
+                "Mock Latency (s)",
+                min_value=0.0,
+                max_value=30.0,
+                value=float(st.session_state.mock_latency),
+                step=0.1,
+                help="Delay before the first token"
+            )
+            st.session_state.mock_tokens_per_second = st.number_input(
+                "Mock Tokens per Second",
+                min_value=1.0,
+                max_value=10_000.0,
+                value=float(st.session_state.mock_tokens_per_second),
+                step=10.0
+            )
+        else:
+            st.session_state.llm_base_url = st.text_input(
+                "API Base URL",
+                value=st.session_state.llm_base_url,
+                placeholder="https://api.openai.com/v1",
+                help="Leave empty for OpenAI, or point at any OpenAI-compatible server"
+            )
+        chat_models = list(CHAT_MODELS)
+        st.session_state.chat_model = st.selectbox(
+            "Model",
+            options=chat_models,
+            index=chat_models.index(st.session_state.chat_model),
+            help="Documents are packed to fit this model's context window"
+        )
+        st.session_state.response_max_tokens = st.number_input(
+            "Max Response Tokens",
+            min_value=100,
+            max_value=16_000,
+            value=st.session_state.response_max_tokens,
+            step=100,
+            help="Reserved for the reply; the rest of the window holds documents and chat history"
+        )
+        st.session_state.history_recent_turns = st.number_input(
+            "Verbatim Turns",
+            min_value=1,
+            max_value=50,
+            value=st.session_state.history_recent_turns,
+            help="Most recent question/answer pairs sent word for word; older ones are summarized"
+        )
+        st.session_state.history_max_tokens = st.number_input(
+            "History Token Limit",
+            min_value=500,
+            max_value=100_000,
+            value=st.session_state.history_max_tokens,
+            step=500,
+            help="Verbatim turns beyond this are folded into the summary"
+        )
+        st.session_state.response_cache_enabled = st.checkbox(
+            "Reuse Cached Answers",
+            value=st.session_state.response_cache_enabled,
+            help="Answer repeated questions about the same documents from a local cache (marked ⚡ cached); never used with the mock backend"
+        )
+        answer_modes = ['retrieval', 'map-reduce', 'auto']
+        st.session_state.answer_mode = st.selectbox(
+            "Answer Mode",
+            options=answer_modes,
+            index=answer_modes.index(st.session_state.answer_mode),
+            help="retrieval sends the best-matching passages; map-reduce asks every document section "
+                 "concurrently and merges the answers; auto uses map-reduce when the documents exceed the model's window"
+        )
+        st.session_state.map_concurrency = st.number_input(
+            "Map-Reduce Concurrency",
+            min_value=1,
+            max_value=64,
+            value=st.session_state.map_concurrency,
+            help="Section requests in flight at once"
+        )
+        st.session_state.request_timeout = st.number_input(
+            "Request Timeout (s)",
+            min_value=5.0,
+            max_value=600.0,
+            value=float(st.session_state.request_timeout),
+            step=5.0,
+            help="Per attempt; a timed-out attempt is retried"
+        )
+        st.session_state.request_max_retries = st.number_input(
+            "Max Retries",
+            min_value=0,
+            max_value=10,
+            value=st.session_state.request_max_retries,
+            help="Retries on rate limits (429), server errors (5xx) and connection failures, with jittered exponential backoff"
+        )
+        retry_stats = get_retry_stats()
+        if retry_stats["requests"]:
+            reasons = ", ".join(f"{reason}: {count}" for reason, count in retry_stats["by_reason"].most_common())
+            st.caption(
+                f"🔁 {retry_stats['retries']} retries and {retry_stats['failures']} failures over "
+                f"{retry_stats['requests']} requests" + (f" ({reasons})" if reasons else "")
+            )
+
     # Document upload
     st.markdown("### 📤 Upload Documents")
-    
+
+    with st.expander("🧰 Ingestion Settings"):
+        csv_engines = ['auto', 'pyarrow', 'c']
+        st.session_state.csv_engine = st.selectbox(
+            "CSV/TSV Engine",
+            options=csv_engines,
+            index=csv_engines.index(st.session_state.csv_engine),
+            help="'auto' uses pyarrow when installed, otherwise pandas' C engine"
+        )
+        st.session_state.ingest_memory_limit_mb = st.number_input(
+            "Memory Limit per Data File (MB)",
+            min_value=64,
+            max_value=65536,
+            value=st.session_state.ingest_memory_limit_mb,
+            step=256,
+            help="Stop reading rows once a parsed file would exceed this size"
+        )
+        st.session_state.csv_chunk_rows = st.number_input(
+            "CSV Chunk Size (rows)",
+            min_value=10_000,
+            max_value=5_000_000,
+            value=st.session_state.csv_chunk_rows,
+            step=50_000,
+            help="Rows parsed per chunk by the C engine"
+        )
+        excel_backends = ['auto'] + list(EXCEL_BACKENDS)
+        st.session_state.excel_backend = st.selectbox(
+            "Excel Reader",
+            options=excel_backends,
+            index=excel_backends.index(st.session_state.excel_backend),
+            help="calamine is much faster than openpyxl; without python-calamine installed, pandas' default reader is used"
+        )
+        st.session_state.profile_sample_rows = st.number_input(
+            "Profile Sample Rows",
+            min_value=1_000,
+            max_value=10_000_000,
+            value=st.session_state.profile_sample_rows,
+            step=10_000,
+            help="Larger samples give more accurate summary statistics for big files"
+        )
+        st.session_state.retrieval_top_k = st.slider(
+            "Passages per Question",
+            min_value=2,
+            max_value=30,
+            value=st.session_state.retrieval_top_k,
+            help="How many of the best-matching text chunks are sent with each question for large uploads"
+        )
+        retrieval_modes = ['hybrid', 'keyword', 'semantic']
+        st.session_state.retrieval_mode = st.selectbox(
+            "Retrieval Mode",
+            options=retrieval_modes,
+            index=retrieval_modes.index(st.session_state.retrieval_mode),
+            help="keyword = BM25, semantic = offline hashed TF-IDF vectors (random projection), hybrid fuses both rankings"
+        )
+        st.session_state.compact_dtypes = st.checkbox(
+            "Compact Data Types",
+            value=st.session_state.compact_dtypes,
+            help="Store repetitive text as categories and other text as Arrow strings to cut memory use "
+                 "(category columns list unused categories in groupby results)"
+        )
+        st.session_state.downcast_numeric = st.checkbox(
+            "Downcast Numbers",
+            value=st.session_state.downcast_numeric,
+            disabled=not st.session_state.compact_dtypes,
+            help="Also store 64-bit numbers as int32/float32 when every value fits exactly"
+        )
+    ingest_options = {
+        "csv_engine": st.session_state.csv_engine,
+        "memory_limit_mb": int(st.session_state.ingest_memory_limit_mb),
+        "chunk_rows": int(st.session_state.csv_chunk_rows),
+        "excel_backend": st.session_state.excel_backend,
+        "profile_sample_rows": int(st.session_state.profile_sample_rows),
+        "compact_dtypes": st.session_state.compact_dtypes,
+        "downcast_numeric": st.session_state.compact_dtypes and st.session_state.downcast_numeric
+    }
 
     uploaded_files = st.file_uploader(
         "Choose documents (TXT, PDF, DOC, DOCX, CSV, XLSX, TSV)",
@@ -1486,28 +3791,26 @@ with st.sidebar:
         accept_multiple_files=True
     )
 
+    # Parse new uploads concurrently, then fold finished ones into the document registry
+    jobs = st.session_state.ingest_jobs
+    upload_keys = [get_upload_key(uploaded_file, ingest_options) for uploaded_file in uploaded_files or []]
+    for key, uploaded_file in zip(upload_keys, uploaded_files or []):
+        if key not in jobs and key not in st.session_state.doc_registry:
+            jobs[key] = start_ingest_job(uploaded_file, ingest_options)
+    ingest_errors = sync_document_registry(upload_keys)
+
     if uploaded_files:        
         # Add gap between file uploader widget and uploaded files card
         st.markdown("<div style='margin: 1.5rem 0 0 0;'></div>", unsafe_allow_html=True)
-        # Load all documents
-        documents = []
-        dataframes = {}
-        for uploaded_file in uploaded_files:
-            content, name, file_type, df = load_document(uploaded_file)
-            if content:
-                doc_dict = {"name": name, "content": content, "type": file_type}
-                if df is not None:
-                    # Store dataframe with a clean variable name
-                    var_name = name.split('.')[0].replace(' ', '_').replace('-', '_')
-                    dataframes[var_name] = df
-                    doc_dict['dataframe'] = var_name
-                documents.append(doc_dict)
-        
+        # While files parse, only the progress fragment refreshes, not the whole page
+        parsing = any(key in jobs for key in upload_keys)
+        st.fragment(render_ingest_progress, run_every=INGEST_POLL_SECONDS if parsing else None)(upload_keys)
+        for error in ingest_errors:
+            st.error(error)
+
+        documents = st.session_state.documents
+        dataframes = st.session_state.dataframes
         if documents:
-            st.session_state.documents = documents
-            st.session_state.dataframes = dataframes
-            st.session_state.combined_content = combine_documents(documents)
-            
             # Display document stats
             st.markdown("#### 📊 Document Statistics")
             
@@ -1519,21 +3822,39 @@ with st.sidebar:
                 icon = "📊" if doc['type'] == 'data' else "📄"
                 if doc['type'] == 'data':
                     data_files += 1
-                    # Show dataframe preview for data files
-                    df_name = doc.get('dataframe', '')
-                    if df_name in dataframes:
+                    # Show dataframe preview for data files (one per workbook sheet)
+                    sheet_names = doc.get('sheets', [])
+                    multi_sheet = len(sheet_names) + len(doc.get('sheet_errors', {})) > 1
+                    for df_idx, df_name in enumerate(doc.get('dataframes', [])):
                         df = dataframes[df_name]
+                        label = f"{doc['name']} › {sheet_names[df_idx]}" if multi_sheet else doc['name']
+                        rows = f"{df.shape[0]:,}" if df.shape[0] is not None else f"over {WORKBOOK_PREVIEW_ROWS:,} (loaded on first use)"
                         st.markdown(f"""
                         <div class="stats-box" style="margin-bottom: 0.5rem;">
-                            <strong>{icon} {doc['name']}</strong> (Data File)<br>
-                            Rows: {df.shape[0]:,} | Columns: {df.shape[1]:,}
+                            <strong>{icon} {label}</strong> (Data File)<br>
+                            Rows: {rows} | Columns: {df.shape[1]:,}
                         </div>
                         """, unsafe_allow_html=True)
-                        with st.expander(f"Preview {doc['name']}"):
-                            st.dataframe(df.head(10), use_container_width=True)
+                        if sheet_names:
+                            st.caption(f"⏱️ Sheet parsed in {doc['sheet_seconds'][sheet_names[df_idx]]:.2f}s")
+                        with st.expander(f"Preview {label}"):
+                            try:
+                                st.dataframe(df.head(10), use_container_width=True)
+                            except OSError as e:
+                                st.warning(f"Preview unavailable: {e}")
+                    for sheet_name, error in doc.get('sheet_errors', {}).items():
+                        st.warning(f"Sheet '{sheet_name}' of {doc['name']} could not be read: {error}")
+                    if doc.get('footprint'):
+                        before, after = doc['footprint']
+                        st.caption(f"🗜️ Memory: {before / 1024 ** 2:,.1f} MB → {after / 1024 ** 2:,.1f} MB")
+                    ingest = doc.get('ingest')
+                    if ingest:
+                        st.caption(f"⏱️ Read {ingest['rows_per_sec']:,.0f} rows/s ({ingest['engine']} engine)")
+                        if ingest['truncated']:
+                            st.warning(f"Only the first {ingest['rows']:,} rows of {doc['name']} fit in the {ingest['memory_limit_mb']:,} MB memory limit")
                 else:
                     text_files += 1
-                    stats = get_document_stats(doc['content'])
+                    stats = doc['stats']
                     st.markdown(f"""
                     <div class="stats-box" style="margin-bottom: 0.5rem;">
                         <strong>{icon} {doc['name']}</strong><br>
@@ -1587,6 +3908,30 @@ with st.sidebar:
             help="Choose format for downloading plots (HTML for Plotly charts)"
         )
         
+        st.session_state.plot_downsample = st.checkbox(
+            "Downsample Large Plots",
+            value=st.session_state.plot_downsample,
+            help=f"Lines over {PLOT_MAX_LINE_POINTS:,} points are reduced with LTTB, scatters over "
+                 f"{PLOT_MAX_SCATTER_POINTS:,} points are binned or sampled, and interactive charts send at most "
+                 f"{PLOT_MAX_CLIENT_POINTS:,} points to the browser"
+        )
+        st.session_state.plot_isolation = st.checkbox(
+            "Isolate Plot Code",
+            value=st.session_state.plot_isolation,
+            disabled=not PLOT_ISOLATION_AVAILABLE,
+            help=f"Run generated plot code in separate clean Python processes without access to the app's memory or "
+                 f"API keys, with a time limit and a {PLOT_MEMORY_LIMIT_MB:,} MB memory cap. This stops runaway code, "
+                 f"not deliberately hostile code."
+        )
+        st.session_state.plot_timeout = st.number_input(
+            "Plot Timeout (s)",
+            min_value=1.0,
+            max_value=600.0,
+            value=float(st.session_state.plot_timeout),
+            step=5.0,
+            help="Isolated plot code running longer than this is stopped"
+        )
+
         st.markdown(f"**Current Size:** {st.session_state.plot_width} × {st.session_state.plot_height} inches")
 
     # st.markdown("---")
@@ -1606,6 +3951,33 @@ with st.sidebar:
             time.sleep(0.5)
             st.rerun()
 
+    # Session request metrics
+    if st.session_state.request_log:
+        st.markdown("### 📈 Request Metrics")
+        aggregate = summarize_request_log(st.session_state.request_log)
+
+        def p50_p95(pair):
+            return f"{pair[0]:.2f}s / {pair[1]:.2f}s" if pair else "–"
+
+        st.caption(
+            f"{aggregate['requests']} requests · {aggregate['cached']} cached · {aggregate['errors']} errors\n\n"
+            f"TTFT p50/p95: {p50_p95(aggregate['ttft'])}\n\n"
+            f"Latency p50/p95: {p50_p95(aggregate['latency'])}\n\n"
+            f"Queue p50/p95: {p50_p95(aggregate['queue'])}\n\n"
+            f"Tokens: {aggregate['prompt_tokens']:,} prompt, {aggregate['completion_tokens']:,} completion"
+            + (f" · {aggregate['tokens_per_second']:.1f} tokens/s" if aggregate['tokens_per_second'] else "")
+            + (f"\n\nMap-reduce map calls: {aggregate['map_tokens']:,} tokens" if aggregate['map_tokens'] else "")
+            + (f"\n\nHistory summaries: {aggregate['summary_calls']} calls, {aggregate['summary_tokens']:,} tokens"
+               if aggregate['summary_calls'] else "")
+        )
+        st.download_button(
+            label="⬇️ Export Metrics (JSONL)",
+            data="".join(json.dumps(metrics) + "\n" for metrics in st.session_state.request_log),
+            file_name="request_metrics.jsonl",
+            mime="application/jsonl",
+            use_container_width=True
+        )
+
     # Conversation history
     if st.session_state.conversation_history:
         st.markdown("---")
@@ -1634,12 +4006,13 @@ st.markdown('<p class="main-header">📄 AI Multi-Document & Data Chat Assistant
 st.markdown('<p class="sub-header">Upload documents and data files, chat with them, and generate visualizations using AI</p>', unsafe_allow_html=True)
 
 # Check if ready to chat
-if not st.session_state.api_key:
+if not st.session_state.api_key and st.session_state.llm_backend != 'mock':
     st.info("👈 Please enter your OpenAI API key in the sidebar to get started")
 elif not st.session_state.combined_content:
     st.info("👈 Please upload documents or data files (TXT, PDF, DOC, DOCX, CSV, XLSX, TSV) in the sidebar to begin chatting")
 else:
     # Display chat messages
+    frame_fingerprints = {}  # Dataframe fingerprints for plot cache keys, computed once per rerun
     for idx, message in enumerate(st.session_state.messages):
         role = message["role"]
         content = message["content"]
@@ -1650,191 +4023,263 @@ else:
                 unsafe_allow_html=True
             )
         else:
-            # Process AI message: extract and hide code blocks, show only text
-            display_content = content
-            
-            # Remove Python code blocks from display (but we'll still execute them)
-            if '```python' in content:
-                lines = content.split('\n')
-                filtered_lines = []
-                in_code_block = False
-                
-                for line in lines:
-                    if line.strip().startswith('```python'):
-                        in_code_block = True
-                    elif line.strip() == '```' and in_code_block:
-                        in_code_block = False
-                    elif not in_code_block:
-                        filtered_lines.append(line)
-                
-                display_content = '\n'.join(filtered_lines).strip()
-            
+            # AI message: code blocks are hidden from the text (but still executed below)
+            parsed = parsed_message(message)
+            display_content = parsed['display']
+
+            cached_marker = ' <span title="Served from the response cache">⚡ cached</span>' if message.get("cached") else ""
             st.markdown(
-                f'<div class="chat-message assistant-message"><strong>🤖 AI:</strong><br>{display_content}</div>',
+                f'<div class="chat-message assistant-message"><strong>🤖 AI:</strong>{cached_marker}<br>{display_content}</div>',
                 unsafe_allow_html=True
             )
+            context_stats = message.get("context")
+            if context_stats:
+                trimmed = (f", {context_stats['trimmed_sections']} of {context_stats['sections']} sections trimmed"
+                           if context_stats['trimmed_sections'] else "")
+                st.caption(
+                    f"📦 {context_stats['prompt_tokens']:,} prompt tokens "
+                    f"({context_stats['document_tokens']:,} from documents{trimmed}) · "
+                    f"{context_stats['model']}, {context_stats['context_window']:,}-token window · "
+                    f"{context_stats['tokenizer']}"
+                    + (f" · {context_stats['summarized_messages']} earlier messages summarized"
+                       if context_stats.get('summarized_messages') else "")
+                    + (f" · ⏱️ first token {context_stats['ttft_seconds']:.2f}s"
+                       if 'ttft_seconds' in context_stats else "")
+                    + (f", total {context_stats['total_seconds']:.2f}s"
+                       if 'total_seconds' in context_stats else "")
+                    + (f" · 🔁 {context_stats['retries']} retries" if context_stats.get('retries') else "")
+                )
+                if context_stats.get('requested_max_tokens', context_stats['max_tokens']) > context_stats['max_tokens']:
+                    st.warning(
+                        f"Max response tokens was lowered from {context_stats['requested_max_tokens']:,} to "
+                        f"{context_stats['max_tokens']:,} to leave room for the documents in {context_stats['model']}'s window"
+                    )
+                if context_stats.get('omitted_sections'):
+                    st.warning(
+                        f"{context_stats['omitted_sections']} of {context_stats['sections']} document sections did not fit "
+                        f"the context window and were left out of this answer; lower Max Response Tokens or the "
+                        f"History Token Limit, or pick a model with a larger window"
+                    )
+                map_stats = context_stats.get("map_reduce")
+                if map_stats:
+                    shard_seconds = map_stats["shard_seconds"] or [0.0]
+                    st.caption(
+                        f"🗺️ Map-reduce over {map_stats['shards']} shards "
+                        f"({map_stats['relevant_shards']} relevant"
+                        + (f", {map_stats['failed_shards']} failed" if map_stats['failed_shards'] else "")
+                        + f") · map {map_stats['map_seconds']:.2f}s wall, {map_stats['wall_seconds']:.2f}s overall · "
+                        f"shard latency mean {sum(shard_seconds) / len(shard_seconds):.2f}s, max {max(shard_seconds):.2f}s"
+                    )
+            metrics = message.get("metrics")
+            if metrics:
+                with st.expander("📈 Request metrics"):
+                    st.markdown(
+                        f"- **Queue:** {format_seconds(metrics['queue_seconds'])}\n"
+                        f"- **Time to first token:** {format_seconds(metrics['ttft_seconds'])}\n"
+                        f"- **Request:** {format_seconds(metrics['request_seconds'])} · **End to end:** {format_seconds(metrics['latency_seconds'])}\n"
+                        f"- **Tokens:** {metrics['prompt_tokens'] or 0:,} prompt, {metrics['completion_tokens'] or 0:,} completion "
+                        f"({metrics['token_source']})\n"
+                        f"- **Throughput:** " + (f"{metrics['tokens_per_second']:.1f} tokens/s" if metrics['tokens_per_second'] else "–")
+                        + (f"\n- **Map phase:** {format_seconds(metrics.get('map_seconds'))}, "
+                           f"{metrics.get('map_prompt_tokens') or 0:,} prompt, {metrics.get('map_completion_tokens') or 0:,} completion tokens"
+                           if metrics.get('map_reduce') else "")
+                        + (f"\n- **History summary:** {format_seconds(metrics.get('summary_seconds'))}, "
+                           f"{metrics.get('summary_prompt_tokens') or 0:,} prompt, {metrics.get('summary_completion_tokens') or 0:,} completion tokens"
+                           if metrics.get('summary_seconds') is not None else "")
+                        + f"\n- **Model:** {metrics['model']} via {metrics['backend']}"
+                        + (" · ⚡ cached" if metrics['cached'] else "")
+                    )
             
-            # Check if this message has associated plots
-            if '```python' in content and st.session_state.dataframes:
-                # Extract and display plots
-                lines = content.split('\n')
-                in_code_block = False
-                current_code = []
-                plot_counter = 0
-                
-                for line in lines:
-                    if line.strip().startswith('```python'):
-                        in_code_block = True
-                        current_code = []
-                    elif line.strip() == '```' and in_code_block:
-                        in_code_block = False
-                        if current_code:
-                            code = '\n'.join(current_code)
-                            if any(plot_lib in code for plot_lib in ['plt.', 'sns.', 'px.', 'go.']):
-                                # Try to generate and display the plot
-                                plot_counter += 1
-                                try:
-                                    if 'px.' in code or 'go.' in code:
-                                        # Plotly plot
-                                        namespace = {
-                                            'pd': pd,
-                                            'px': px,
-                                            'go': go,
-                                            **st.session_state.dataframes
-                                        }
-                                        # Add 'df' alias if single dataframe
-                                        if len(st.session_state.dataframes) == 1:
-                                            namespace['df'] = list(st.session_state.dataframes.values())[0]
-                                        
-                                        # Update plotly figure sizes
-                                        width_px = st.session_state.plot_width * 100
-                                        height_px = st.session_state.plot_height * 100
-                                        
-                                        exec(code, namespace)
-                                        # Get the figure from namespace if it was assigned to a variable
-                                        plotly_fig = None
-                                        for var_name in ['fig', 'figure']:
-                                            if var_name in namespace:
-                                                plotly_fig = namespace[var_name]
-                                                plotly_fig.update_layout(width=width_px, height=height_px)
-                                                st.plotly_chart(plotly_fig, use_container_width=True)
-                                                
-                                                # Add download button for Plotly
-                                                col1, col2, col3 = st.columns([1, 1, 4])
-                                                with col1:
-                                                    # Plotly HTML export (always available)
-                                                    html_bytes = io.BytesIO()
-                                                    plotly_fig.write_html(html_bytes)
-                                                    html_bytes.seek(0)
-                                                    st.download_button(
-                                                        label="📥 HTML",
-                                                        data=html_bytes,
-                                                        file_name=f"plot_{idx}_{plot_counter}.html",
-                                                        mime="text/html",
-                                                        key=f"download_plotly_html_{idx}_{plot_counter}",
-                                                        help="Download as interactive HTML"
-                                                    )
-                                                with col2:
-                                                    # Try image export (requires kaleido)
-                                                    try:
-                                                        if st.session_state.plot_format in ['png', 'svg', 'pdf']:
-                                                            img_bytes = io.BytesIO()
-                                                            plotly_fig.write_image(img_bytes, format=st.session_state.plot_format)
-                                                            img_bytes.seek(0)
-                                                            st.download_button(
-                                                                label=f"📥 {st.session_state.plot_format.upper()}",
-                                                                data=img_bytes,
-                                                                file_name=f"plot_{idx}_{plot_counter}.{st.session_state.plot_format}",
-                                                                mime=f"image/{st.session_state.plot_format}",
-                                                                key=f"download_plotly_img_{idx}_{plot_counter}",
-                                                                help=f"Download as {st.session_state.plot_format.upper()}"
-                                                            )
-                                                    except Exception as img_err:
-                                                        st.caption("⚠️ Install: pip install kaleido")
-                                                break
-                                    else:
-                                        # Matplotlib/Seaborn plot
-                                        fig = generate_plot_from_code(
-                                            code, 
-                                            st.session_state.dataframes,
-                                            st.session_state.plot_width,
-                                            st.session_state.plot_height
-                                        )
-                                        if fig:
-                                            st.pyplot(fig)
-                                            
-                                            # Add download button
-                                            col1, col2, col3 = st.columns([1, 1, 4])
-                                            with col1:
-                                                plot_bytes = save_plot_to_bytes(fig, st.session_state.plot_format)
-                                                st.download_button(
-                                                    label=f"📥 {st.session_state.plot_format.upper()}",
-                                                    data=plot_bytes,
-                                                    file_name=f"plot_{idx}_{plot_counter}.{st.session_state.plot_format}",
-                                                    mime=f"image/{st.session_state.plot_format}" if st.session_state.plot_format != 'pdf' else "application/pdf",
-                                                    key=f"download_{idx}_{plot_counter}",
-                                                    help=f"Download plot as {st.session_state.plot_format.upper()} ({st.session_state.plot_width}×{st.session_state.plot_height} in, 300 DPI)"
-                                                )
-                                            
-                                            plt.close()
-                                except Exception as e:
-                                    st.error(f"Could not generate plot: {str(e)}")
-                    elif in_code_block:
-                        current_code.append(line)
+            # Show this message's plots
+            if parsed['plot_blocks'] and st.session_state.dataframes:
+                for plot_counter, block in enumerate(parsed['plot_blocks'], 1):
+                    code = block['code']
+                    # Display the plot, rendering it only if it is not cached yet
+                    rendered = get_rendered_plot(
+                        code,
+                        st.session_state.dataframes,
+                        st.session_state.plot_width,
+                        st.session_state.plot_height,
+                        frame_fingerprints,
+                        st.session_state.plot_isolation,
+                        st.session_state.plot_timeout,
+                        st.session_state.plot_downsample
+                    )
+                    # Download files are encoded only when a button is clicked
+                    export_data = functools.partial(
+                        get_plot_export, rendered, code, st.session_state.dataframes,
+                        st.session_state.plot_width, st.session_state.plot_height,
+                        fingerprints=frame_fingerprints, isolated=st.session_state.plot_isolation,
+                        timeout_seconds=st.session_state.plot_timeout, downsample=st.session_state.plot_downsample
+                    )
+                    if rendered['error']:
+                        st.error(f"Could not generate plot: {rendered['error']}")
+                    elif rendered['kind'] == 'plotly' and rendered.get('figure') is not None:
+                        st.plotly_chart(rendered['figure'], use_container_width=True)
+
+                        # Add download button for Plotly
+                        col1, col2, col3 = st.columns([1, 1, 4])
+                        with col1:
+                            # Plotly HTML export (always available)
+                            st.download_button(
+                                label="📥 HTML",
+                                data=functools.partial(export_data, export_format='html'),
+                                file_name=f"plot_{idx}_{plot_counter}.html",
+                                mime=EXPORT_MIME_TYPES['html'],
+                                key=f"download_plotly_html_{idx}_{plot_counter}",
+                                help="Download as interactive HTML"
+                            )
+                        with col2:
+                            if st.session_state.plot_format in ['png', 'svg', 'pdf']:
+                                if KALEIDO_AVAILABLE:
+                                    st.download_button(
+                                        label=f"📥 {st.session_state.plot_format.upper()}",
+                                        data=functools.partial(export_data, export_format=st.session_state.plot_format),
+                                        file_name=f"plot_{idx}_{plot_counter}.{st.session_state.plot_format}",
+                                        mime=EXPORT_MIME_TYPES[st.session_state.plot_format],
+                                        key=f"download_plotly_img_{idx}_{plot_counter}",
+                                        help=f"Download as {st.session_state.plot_format.upper()}"
+                                    )
+                                else:
+                                    st.caption("⚠️ Install: pip install kaleido")
+                    elif rendered.get('image'):
+                        st.image(rendered['image'])
+
+                        # Add download button
+                        export_format = st.session_state.plot_format if st.session_state.plot_format in ['png', 'svg', 'pdf'] else 'png'
+                        col1, col2, col3 = st.columns([1, 1, 4])
+                        with col1:
+                            st.download_button(
+                                label=f"📥 {export_format.upper()}",
+                                data=functools.partial(export_data, export_format=export_format),
+                                file_name=f"plot_{idx}_{plot_counter}.{export_format}",
+                                mime=EXPORT_MIME_TYPES[export_format],
+                                key=f"download_{idx}_{plot_counter}",
+                                help=f"Download plot as {export_format.upper()} ({st.session_state.plot_width}×{st.session_state.plot_height} in, 300 DPI)"
+                            )
+                    if rendered.get('reductions') and not rendered['error']:
+                        st.caption("📉 Simplified for display: " + "; ".join(rendered['reductions']))
+                    if rendered.get('exec_seconds') is not None and not rendered['error']:
+                        st.caption(
+                            f"⏱️ Plot code ran in {rendered['exec_seconds']:.2f}s"
+                            + (" (isolated)" if rendered.get('isolated') else "")
+                        )
 
     # Chat input
     doc_text = "documents" if len(st.session_state.documents) > 1 else "document"
     user_input = st.chat_input(f"Ask a question about your {doc_text}...")
 
     if user_input:
+        submitted_at = time.perf_counter()
         # Add user message
         st.session_state.messages.append({
             "role": "user",
             "content": user_input
         })
 
-        # Get AI response with spinner
-        with st.spinner("🤔 AI is thinking..."):
-            has_data = any(doc.get('type') == 'data' for doc in st.session_state.documents)
-            df_names = [doc.get('dataframe') for doc in st.session_state.documents if doc.get('dataframe')]
-            ai_response = get_ai_response(
-                st.session_state.messages,
-                st.session_state.api_key,
-                st.session_state.combined_content,
-                len(st.session_state.documents),
-                has_data,
-                df_names
-            )
+        st.markdown(
+            f'<div class="chat-message user-message"><strong>🧑 You:</strong><br>{user_input}</div>',
+            unsafe_allow_html=True
+        )
+        answer_placeholder = st.empty()
+        answer_placeholder.markdown(
+            '<div class="chat-message assistant-message"><strong>🤖 AI:</strong><br>🤔 AI is thinking...</div>',
+            unsafe_allow_html=True
+        )
+
+        cache_key = response_cache_key(st.session_state.documents, st.session_state.messages, {
+            "model": st.session_state.chat_model,
+            "max_tokens": st.session_state.response_max_tokens,
+            "answer_mode": st.session_state.answer_mode,
+            "retrieval_mode": st.session_state.retrieval_mode,
+            "retrieval_top_k": st.session_state.retrieval_top_k,
+            "history_recent_turns": st.session_state.history_recent_turns,
+            "history_max_tokens": st.session_state.history_max_tokens,
+            # Answers from different backends or OpenAI-compatible servers are not interchangeable
+            "llm_backend": st.session_state.llm_backend,
+            "llm_base_url": st.session_state.llm_base_url,
+        })
+        # Mock (load-test) traffic must exercise the full pipeline and must not fill the shared cache
+        use_response_cache = st.session_state.response_cache_enabled and st.session_state.llm_backend != 'mock'
+        cached = response_cache_get(cache_key) if use_response_cache else None
+
+        if cached:
+            ai_response, message_stats = cached["response"], cached["stats"]
+        else:
+            # Prepare context with spinner, then stream the answer into the bubble
+            with st.spinner("📚 Preparing context..."):
+                has_data = any(doc.get('type') == 'data' for doc in st.session_state.documents)
+                df_names = [df_name for doc in st.session_state.documents for df_name in doc.get('dataframes', [])]
+                use_map_reduce = st.session_state.answer_mode == 'map-reduce' or (
+                    st.session_state.answer_mode == 'auto' and not documents_fit_window(
+                        st.session_state.documents, st.session_state.chat_model, st.session_state.response_max_tokens
+                    )
+                )
+                # Map-reduce reads every section itself, so retrieval only serves the single-call path
+                if not use_map_reduce:
+                    # Retrieve with the latest question plus the one before it, for follow-ups
+                    recent_questions = [m["content"] for m in st.session_state.messages if m["role"] == "user"][-2:]
+                    document_context = build_retrieval_context(" ".join(recent_questions), st.session_state.documents)
+                history, history_stats = compact_history(
+                    st.session_state.messages,
+                    st.session_state.api_key,
+                    st.session_state.chat_model,
+                    st.session_state.history_recent_turns,
+                    st.session_state.history_max_tokens
+                )
+            if use_map_reduce:
+                answer_placeholder.markdown(
+                    '<div class="chat-message assistant-message"><strong>🤖 AI:</strong><br>🗺️ Reading every document section...</div>',
+                    unsafe_allow_html=True
+                )
+                ai_response, context_stats = map_reduce_answer(
+                    history,
+                    st.session_state.api_key,
+                    st.session_state.documents,
+                    has_data,
+                    df_names,
+                    st.session_state.chat_model,
+                    st.session_state.response_max_tokens,
+                    on_token=make_stream_writer(answer_placeholder),
+                    submitted_at=submitted_at
+                )
+            else:
+                ai_response, context_stats = get_ai_response(
+                    history,
+                    st.session_state.api_key,
+                    document_context,
+                    len(st.session_state.documents),
+                    has_data,
+                    df_names,
+                    st.session_state.chat_model,
+                    st.session_state.response_max_tokens,
+                    on_token=make_stream_writer(answer_placeholder),
+                    submitted_at=submitted_at
+                )
+            message_stats = {**context_stats, **history_stats}
+            if use_response_cache and not ai_response.startswith("Error:"):
+                response_cache_put(cache_key, ai_response, message_stats)
+
+        metrics = build_request_metrics(
+            message_stats, ai_response, submitted_at, st.session_state.chat_model,
+            st.session_state.llm_backend, cached is not None
+        )
+        st.session_state.request_log.append(metrics)
 
-        # Add assistant message
+        # Add assistant message only once the answer is complete, parsed once for every later render
+        parsed = parse_assistant_message(ai_response)
         st.session_state.messages.append({
             "role": "assistant",
-            "content": ai_response
+            "content": ai_response,
+            "parsed": parsed,
+            "context": message_stats,
+            "cached": cached is not None,
+            "metrics": metrics
         })
-        
-        # Check if response contains Python code for plotting
-        if '```python' in ai_response and st.session_state.dataframes:
-            # Extract code blocks
-            code_blocks = []
-            lines = ai_response.split('\n')
-            in_code_block = False
-            current_code = []
-            
-            for line in lines:
-                if line.strip().startswith('```python'):
-                    in_code_block = True
-                    current_code = []
-                elif line.strip() == '```' and in_code_block:
-                    in_code_block = False
-                    if current_code:
-                        code_blocks.append('\n'.join(current_code))
-                elif in_code_block:
-                    current_code.append(line)
-            
-            # Try to execute each code block
-            for code in code_blocks:
-                if any(plot_lib in code for plot_lib in ['plt.', 'sns.', 'px.', 'go.']):
-                    st.session_state.plots.append(code)
+
+        # Keep the plot code blocks
+        if st.session_state.dataframes:
+            st.session_state.plots.extend(block['code'] for block in parsed['plot_blocks'])
 
         # Rerun to display new messages
         st.rerun()
@@ -0,0 +1,191 @@
+"""Dataframe handles, dtype compaction and the columnar spill store for the document chat app
+
+Kept out of the Streamlit script because Streamlit re-executes that script into a fresh
+module on every rerun. Classes defined there change identity between reruns, so handles
+built by a background ingest thread started in an earlier run could not be pickled into
+the ingestion cache. Classes defined here keep one identity for the life of the process.
+"""
+import io
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is optional; dataframes stay resident without it
+    pa = None
+
+# Dtype compaction settings
+COMPACT_CATEGORY_RATIO = 0.5  # Strings with at most this share of distinct values become categoricals
+
+
+def compact_dataframe(df: pd.DataFrame, category_ratio: float = None, downcast_numeric: bool = False) -> tuple[pd.DataFrame, int, int]:
+    """Shrink dtypes: turn low-cardinality strings into categoricals and the rest into Arrow strings
+    With downcast_numeric, 64-bit columns whose values fit also become int32/float32. Integers are
+    never narrowed below int32 or made unsigned, so arithmetic in analysis code cannot wrap around.
+    Returns: (compacted dataframe, bytes before, bytes after)
+    """
+    category_ratio = COMPACT_CATEGORY_RATIO if category_ratio is None else category_ratio
+    before = int(df.memory_usage(deep=True).sum())
+
+    dtypes = {}
+    for col in df.columns:
+        series = df[col]
+        kind = series.dtype.kind
+        # Only plain NumPy columns are narrowed; nullable extension types keep their NA handling
+        wide_numpy = downcast_numeric and isinstance(series.dtype, np.dtype) and series.dtype.itemsize > 4
+        if kind == 'i' and wide_numpy and len(series):
+            int32 = np.iinfo(np.int32)
+            if int32.min <= series.min() and series.max() <= int32.max:
+                dtypes[col] = 'int32'
+        elif kind == 'f' and wide_numpy:
+            as_float32 = series.to_numpy(dtype='float32')
+            if np.array_equal(as_float32.astype('float64'), series.to_numpy(dtype='float64'), equal_nan=True):
+                dtypes[col] = 'float32'
+        elif kind == 'O' or isinstance(series.dtype, pd.StringDtype):
+            non_null = series.count()
+            if non_null and series.nunique(dropna=True) <= category_ratio * non_null:
+                dtypes[col] = 'category'
+            elif pa is not None and kind == 'O' and pd.api.types.infer_dtype(series, skipna=True) == 'string':
+                dtypes[col] = 'string[pyarrow]'
+
+    if dtypes:
+        df = df.astype({col: dtype for col, dtype in dtypes.items() if dtype != df[col].dtype})
+    return df, before, int(df.memory_usage(deep=True).sum())
+
+
+def _open_workbook(engine: Optional[str]):
+    """Build a workbook opener for one of pandas' Excel engines"""
+    def open_workbook(data: bytes) -> pd.ExcelFile:
+        return pd.ExcelFile(io.BytesIO(data), engine=engine)
+    return open_workbook
+
+
+# Excel reader backends: name -> callable(bytes) returning an object with
+# .sheet_names and .parse(sheet_name). Register faster readers here.
+EXCEL_BACKENDS = {
+    'calamine': _open_workbook('calamine'),
+    'openpyxl': _open_workbook('openpyxl'),
+    'pandas default': _open_workbook(None),
+}
+
+
+class SpilledFrame:
+    """Handle to a dataframe spilled to an Arrow IPC file and memory-mapped back on demand"""
+
+    def __init__(self, path: str, shape: tuple, columns: List[str]):
+        self.path = path
+        self.shape = shape
+        self.columns = columns
+
+    def _read_table(self):
+        """Memory-map the Arrow file; buffers are paged in lazily by the OS"""
+        try:
+            os.utime(self.path)  # Keep recently used spill files away from LRU eviction
+            return pa.ipc.open_file(pa.memory_map(self.path, 'r')).read_all()
+        except FileNotFoundError:
+            raise FileNotFoundError("The parsed data was removed from the ingestion cache; re-upload the file") from None
+
+    def load(self) -> pd.DataFrame:
+        """Materialize the full dataframe"""
+        return self._read_table().to_pandas(split_blocks=True)
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        """Materialize only the first n rows"""
+        return self._read_table().slice(0, n).to_pandas()
+
+
+class WorkbookSheet:
+    """Handle to a long workbook sheet, parsed from the cached workbook on first use and then spilled"""
+
+    def __init__(self, source_path: str, backend: str, sheet_name: str, spill_path: str, columns: List[str],
+                 head_rows: pd.DataFrame, compact_options: Dict = None):
+        self.source_path = source_path
+        self.backend = backend
+        self.sheet_name = sheet_name
+        self.spill_path = spill_path
+        self.columns = columns
+        self.head_rows = head_rows  # Kept so sidebar previews don't reopen the workbook
+        self.compact_options = compact_options
+        self._frame = None
+
+    @property
+    def shape(self) -> tuple:
+        """Row count is None until the sheet has been parsed"""
+        return self._frame.shape if self._frame is not None else (None, len(self.columns))
+
+    def _parse(self, nrows: int = None) -> pd.DataFrame:
+        """Parse the sheet from the cached workbook, compacting it like the eagerly read sheets"""
+        try:
+            with open(self.source_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise FileNotFoundError("The workbook was removed from the ingestion cache; re-upload the file") from None
+        df = EXCEL_BACKENDS[self.backend](data).parse(self.sheet_name, nrows=nrows)
+        return compact_dataframe(df, **self.compact_options)[0] if self.compact_options else df
+
+    def resolve(self):
+        """Parse and spill the full sheet on first use; later calls (from any session) reuse the result"""
+        if self._frame is None:
+            if pa is not None and os.path.exists(self.spill_path):
+                # Spilled by another process sharing the cache
+                num_rows = pa.ipc.open_file(pa.memory_map(self.spill_path, 'r')).read_all().num_rows
+                self._frame = SpilledFrame(self.spill_path, (num_rows, len(self.columns)), self.columns)
+            else:
+                self._frame = spill_dataframe(self._parse(), self.spill_path)
+        return self._frame
+
+    def load(self) -> pd.DataFrame:
+        """Materialize the full dataframe"""
+        frame = self.resolve()
+        # A sheet that couldn't be spilled stays resident and is shared, so hand out copies
+        return frame.copy() if isinstance(frame, pd.DataFrame) else frame.load()
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        """First n rows, without parsing the whole sheet when the stored preview covers them"""
+        if n <= len(self.head_rows):
+            return self.head_rows.head(n)
+        return self.resolve().head(n)
+
+    def preview(self, nrows: int) -> pd.DataFrame:
+        """The first nrows rows, which the sheet's summary is built from"""
+        return self._parse(nrows)
+
+
+def spill_dataframe(df: pd.DataFrame, path: str):
+    """Write a dataframe to an Arrow IPC file at path and return a SpilledFrame handle
+    Falls back to the in-memory dataframe when pyarrow is missing or can't encode it
+    """
+    if pa is None:
+        return df
+
+    try:
+        if not os.path.exists(path):
+            table = pa.Table.from_pandas(df)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            os.close(fd)
+            with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_path, path)
+    except (pa.ArrowException, OSError, TypeError, ValueError):
+        # e.g. object columns with mixed types; keep this one resident
+        return df
+    return SpilledFrame(path, df.shape, list(df.columns))
+
+
+def detach_frames(df):
+    """Give a session its own copy of resident dataframes so in-place edits stay in that session
+    Spilled handles are shared as-is: every load() materializes a fresh dataframe.
+    """
+    if isinstance(df, dict):
+        return {name: detach_frames(frame) for name, frame in df.items()}
+    return df.copy() if isinstance(df, pd.DataFrame) else df
+
+
+def as_dataframe(df) -> pd.DataFrame:
+    """Return a resident dataframe, loading it from the spill store if needed"""
+    return df if isinstance(df, pd.DataFrame) else df.load()
@@ -0,0 +1,87 @@
+"""PDF page extraction worker for the document chat app
+
+A separate, light entry point: PDF workers only need pypdf, so they are started with
+``python app_pdf_worker.py`` and skip the pandas and plotting imports (and the plot
+warm-up) that plot workers in app_workers pay for.
+"""
+import os
+import sys
+from multiprocessing.connection import Connection
+from typing import Dict, Optional
+
+from pypdf import PdfReader
+
+try:
+    import resource
+except ImportError:  # POSIX only; workers run without a memory cap elsewhere
+    resource = None
+
+PDF_WORKER_SCRIPT = os.path.abspath(__file__)
+
+
+def address_space_bytes() -> Optional[int]:
+    """This process's virtual memory size (Linux), or None where it can't be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def limit_address_space(baseline: Optional[int], memory_limit_mb: int, mapped_bytes: int = 0):
+    """Cap the soft address-space limit at baseline + memory_limit_mb + mapped_bytes
+    Memory-mapped spill files count towards RLIMIT_AS without using RAM, so they are added on
+    top of the budget. The hard limit is left alone so the next request can raise the cap again.
+    """
+    if resource is None or baseline is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = baseline + memory_limit_mb * 1024 * 1024 + mapped_bytes
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (OSError, ValueError):
+        pass
+
+
+def serve_pdf_pages(request: tuple, readers: Dict, baseline: Optional[int], memory_limit_mb: int) -> Dict:
+    """Worker side of a PDF request: the text of pages [start, end) of the PDF at path
+    readers keeps the parsed PDF between requests, so each task only carries a page range.
+    """
+    path, start, end = request
+    limit_address_space(baseline, memory_limit_mb)
+    try:
+        if path not in readers:
+            readers.clear()
+            readers[path] = PdfReader(path)
+        return {'pages': [readers[path].pages[i].extract_text() or "" for i in range(start, end)]}
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+
+def pdf_worker_main(fd: int, memory_limit_mb: int):
+    """Worker loop: answer one PDF request at a time until the app closes the connection"""
+    conn = Connection(fd)
+    baseline = address_space_bytes()
+    readers = {}
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        kind, payload = request
+        if kind == 'pdf_pages':
+            reply = serve_pdf_pages(payload, readers, baseline, memory_limit_mb)
+        else:
+            reply = {'error': f"Unknown request: {kind}"}
+        try:
+            conn.send(reply)
+        except (OSError, ValueError):
+            break
+
+
+if __name__ == '__main__':
+    pdf_worker_main(int(sys.argv[1]), int(sys.argv[2]))
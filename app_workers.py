@@ -0,0 +1,562 @@
+"""Plot rendering and worker processes for the document chat app
+
+Kept out of the Streamlit script so worker interpreters can import it without
+re-running the app: workers are started with ``python app_workers.py`` and share
+none of the server's memory, sessions or API keys.
+"""
+import ast
+import builtins
+import io
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.collections import PathCollection
+import seaborn as sns
+import plotly.express as px
+import plotly.graph_objects as go
+
+try:
+    import pyarrow as pa
+except ImportError:  # Spilled frames are only passed by path when pyarrow is installed
+    pa = None
+
+from app_pdf_worker import address_space_bytes, limit_address_space
+
+# Plot rendering settings
+PLOT_SCREEN_DPI = 100  # On-screen matplotlib resolution; exports are encoded at 300 DPI on request
+
+# Plot data reduction settings (large series are simplified before drawing or shipping to the browser)
+PLOT_MAX_LINE_POINTS = 5_000  # Line series above this are downsampled with LTTB
+PLOT_MAX_SCATTER_POINTS = 20_000  # Scatter series above this are binned or sampled
+PLOT_MAX_CLIENT_POINTS = 100_000  # Total points a Plotly figure may send to the browser
+PLOT_DENSITY_BINS = 200  # Grid size per axis when a scatter is binned into a 2D histogram
+
+# Plot code namespace settings (a guard against runaway or careless code, not a security boundary)
+PLOT_ALLOWED_MODULES = frozenset({
+    'pandas', 'numpy', 'matplotlib', 'mpl_toolkits', 'seaborn', 'plotly', 'scipy', 'math', 'statistics',
+    'datetime', 'calendar', 'collections', 'itertools', 'functools', 'operator', 're', 'string',
+    'textwrap', 'random', 'decimal', 'fractions', 'warnings'
+})
+PLOT_BLOCKED_BUILTINS = frozenset({
+    'open', 'exec', 'eval', 'compile', '__import__', 'input', 'breakpoint', 'exit', 'quit', 'help',
+    'globals', 'locals', 'vars'
+})
+
+# Worker process settings
+WORKER_SCRIPT = os.path.abspath(__file__)
+WORKER_ENV_VARS = ('PATH', 'HOME', 'LANG', 'LC_ALL', 'LC_CTYPE', 'TMPDIR', 'TEMP', 'TMP', 'PYTHONPATH', 'VIRTUAL_ENV')
+
+MATPLOTLIB_LOCK = threading.Lock()  # pyplot keeps global state; serializes in-process rendering
+
+
+def configure_plot_style():
+    """Plotting defaults shared by the app and its workers"""
+    sns.set_style("whitegrid")
+    plt.rcParams['figure.figsize'] = (10, 6)
+    plt.rcParams['font.size'] = 10
+
+
+def _plot_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """__import__ for plot code: only plotting, data and standard helper modules"""
+    if level or name.split('.')[0] not in PLOT_ALLOWED_MODULES:
+        raise ImportError(f"Plot code may not import {name!r}")
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+PLOT_BUILTINS = {name: getattr(builtins, name) for name in dir(builtins) if name not in PLOT_BLOCKED_BUILTINS}
+PLOT_BUILTINS['__import__'] = _plot_import
+
+
+def generate_plot_from_code(code: str, dataframes: Dict[str, pd.DataFrame], width: int = 10, height: int = 6) -> Optional[plt.Figure]:
+    """Execute plotting code and return the figure (errors propagate to the caller)"""
+    # Namespace with pandas, matplotlib, plotly, the dataframes and restricted builtins
+    namespace = {
+        '__builtins__': PLOT_BUILTINS,
+        'pd': pd,
+        'plt': plt,
+        'px': px,
+        'go': go,
+        'sns': sns,
+        **dataframes  # Add all dataframes to namespace
+    }
+
+    # If there's only one dataframe, also create a 'df' alias
+    if len(dataframes) == 1:
+        namespace['df'] = list(dataframes.values())[0]
+
+    # Modify code to use custom figure size if plt.figure() is in the code
+    if 'plt.figure(' in code and 'figsize' not in code:
+        code = code.replace('plt.figure()', f'plt.figure(figsize=({width}, {height}))')
+    elif 'plt.figure(' not in code and ('plt.' in code or 'sns.' in code):
+        # If no plt.figure() but using matplotlib/seaborn, add it at the beginning
+        code = f'plt.figure(figsize=({width}, {height}))\n' + code
+
+    # Execute the code
+    exec(code, namespace)
+
+    # Return the current figure if using matplotlib
+    if plt.get_fignums():
+        return plt.gcf()
+
+    return None
+
+
+def save_plot_to_bytes(fig, format: str = 'png', is_plotly: bool = False) -> io.BytesIO:
+    """Save a plot to bytes buffer for download"""
+    buf = io.BytesIO()
+    
+    if is_plotly:
+        # For Plotly figures
+        if format == 'html':
+            # write_html emits text, which a bytes buffer rejects
+            buf.write(fig.to_html().encode('utf-8'))
+        elif format == 'png':
+            fig.write_image(buf, format='png')
+        elif format == 'svg':
+            fig.write_image(buf, format='svg')
+        elif format == 'pdf':
+            fig.write_image(buf, format='pdf')
+    else:
+        # For Matplotlib figures
+        fig.savefig(buf, format=format, dpi=300, bbox_inches='tight')
+    
+    buf.seek(0)
+    return buf
+
+
+PLOTLY_NAMES = frozenset({'px', 'go'})
+MATPLOTLIB_NAMES = frozenset({'plt', 'sns'})
+
+
+def detect_plot_library(code: str) -> Optional[str]:
+    """'plotly', 'matplotlib' or None for a code block, from its syntax tree rather than substrings
+    Looks at imports and at attribute access on the usual aliases (px., go., plt., sns.);
+    pandas' .plot accessor counts as matplotlib. Code that does not parse is not a plot.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names, modules, uses_plot_accessor = set(), set(), False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            if isinstance(node.value, ast.Name):
+                names.add(node.value.id)
+            uses_plot_accessor = uses_plot_accessor or node.attr == 'plot'
+        elif isinstance(node, ast.Import):
+            modules.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.add(node.module.split('.')[0])
+    if names & PLOTLY_NAMES or 'plotly' in modules:
+        return 'plotly'
+    if names & MATPLOTLIB_NAMES or modules & {'matplotlib', 'seaborn'} or uses_plot_accessor:
+        return 'matplotlib'
+    return None
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: indices of n_out points that best preserve a line's visual shape
+    Keeps the first and last points and, from each bucket in between, the point forming the largest
+    triangle with the previously kept point and the next bucket's average.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # Bucket averages up front; only the choice within each bucket depends on the previous pick
+    next_edges = np.append(edges[1:], n)
+    counts = np.maximum(next_edges - edges, 1)
+    avg_x = np.add.reduceat(x, edges) / counts
+    avg_y = np.add.reduceat(y, edges) / counts
+    avg_x[-1], avg_y[-1] = x[-1], y[-1]
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+        area = np.abs((x[a] - avg_x[bucket + 1]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y[bucket + 1] - y[a]))
+        a = start + int(np.argmax(area))
+        indices[bucket + 1] = a
+    return indices
+
+
+def numeric_axis(values) -> Optional[np.ndarray]:
+    """Float view of numeric or datetime plot coordinates, or None for categorical ones"""
+    array = np.asarray(values)
+    if array.dtype.kind in 'iufb':
+        return array.astype(np.float64)
+    if array.dtype.kind == 'M':
+        return array.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return None
+
+
+def sample_indices(n: int, n_out: int) -> np.ndarray:
+    """Sorted uniform random sample of n_out positions (seeded, so reruns draw the same points)"""
+    return np.sort(np.random.default_rng(0).choice(n, size=n_out, replace=False))
+
+
+def stride_indices(n: int, n_out: int) -> np.ndarray:
+    """n_out evenly spaced positions, first and last included, for series LTTB can't measure"""
+    return np.unique(np.linspace(0, n - 1, n_out).round().astype(np.int64))
+
+
+def reduce_plotly_figure(fig, max_line_points: int = PLOT_MAX_LINE_POINTS, max_scatter_points: int = PLOT_MAX_SCATTER_POINTS,
+                         max_total_points: int = PLOT_MAX_CLIENT_POINTS) -> List[str]:
+    """Downsample a Plotly figure's large scatter traces in place before it is sent to the browser
+    Lines are reduced with LTTB (evenly strided when y isn't numeric). A single large marker trace
+    with one colour on the default axes becomes a 2D-histogram heatmap; other marker traces are
+    sampled, keeping their colour encoding and facet axes. Returns one note per reduced trace.
+    """
+    traces = [trace for trace in fig.data if trace.type in ('scatter', 'scattergl') and trace.y is not None]
+    total = sum(len(trace.y) for trace in traces)
+    marker_traces = [trace for trace in traces if (trace.mode or '') == 'markers']
+    notes, binned = [], []
+    for number, trace in enumerate(traces, 1):
+        n = len(trace.y)
+        # Share the client budget across traces in proportion to their size
+        budget = max(2, max_total_points * n // total) if total > max_total_points else n
+        label = trace.name or f"trace {number}"
+        per_point = {'x': np.arange(n) if trace.x is None else np.asarray(trace.x), 'y': np.asarray(trace.y)}
+        for attr in ('text', 'hovertext', 'customdata', 'ids'):
+            value = getattr(trace, attr)
+            if value is not None and not isinstance(value, str) and len(value) == n:
+                per_point[attr] = np.asarray(value)
+        mode = trace.mode or ('lines' if n >= 20 else 'lines+markers')
+        if 'lines' in mode:
+            target = min(max_line_points, budget)
+            if n <= target:
+                continue
+            x_values, y_values = numeric_axis(per_point['x']), numeric_axis(per_point['y'])
+            if y_values is None:
+                keep, how = stride_indices(n, target), "evenly spaced"
+            else:
+                keep, how = lttb_indices(x_values if x_values is not None else np.arange(n), y_values, target), "LTTB"
+        else:
+            target = min(max_scatter_points, budget)
+            if n <= target:
+                continue
+            x_values, y_values = numeric_axis(per_point['x']), numeric_axis(per_point['y'])
+            marker_colour = trace.marker.color if trace.marker is not None else None
+            single_colour = marker_colour is None or isinstance(marker_colour, (str, int, float))
+            default_axes = trace.xaxis in (None, 'x') and trace.yaxis in (None, 'y')
+            if len(marker_traces) == 1 and single_colour and default_axes and x_values is not None and y_values is not None:
+                finite = np.isfinite(x_values) & np.isfinite(y_values)
+                counts, x_edges, y_edges = np.histogram2d(x_values[finite], y_values[finite], bins=PLOT_DENSITY_BINS)
+                counts[counts == 0] = np.nan
+                binned.append((trace, go.Heatmap(
+                    x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2, z=counts.T,
+                    colorscale='Viridis', colorbar={'title': 'points'}, name=trace.name, hoverongaps=False
+                )))
+                notes.append(f"{label}: {n:,} points binned into a {PLOT_DENSITY_BINS}×{PLOT_DENSITY_BINS} density grid")
+                continue
+            keep = sample_indices(n, target)
+            how = "random sample"
+        marker = trace.marker
+        for attr in ('color', 'size'):
+            value = getattr(marker, attr, None) if marker is not None else None
+            if value is not None and not isinstance(value, (str, int, float)) and len(value) == n:
+                marker[attr] = np.asarray(value)[keep]
+        trace.update({attr: values[keep] for attr, values in per_point.items()})
+        notes.append(f"{label}: {n:,} → {len(keep):,} points ({how})")
+    if binned:
+        replaced = {id(trace) for trace, _ in binned}
+        fig.data = [trace for trace in fig.data if id(trace) not in replaced]
+        for _, heatmap in binned:
+            fig.add_trace(heatmap)
+    return notes
+
+
+def reduce_matplotlib_figure(fig, max_line_points: int = PLOT_MAX_LINE_POINTS, max_scatter_points: int = PLOT_MAX_SCATTER_POINTS) -> List[str]:
+    """Downsample a matplotlib figure's large lines and scatters in place before drawing
+    Lines are reduced with LTTB; a lone single-colour scatter becomes a 2D-histogram mesh, and
+    other scatters are sampled. Returns one note per reduced artist.
+    """
+    notes = []
+    for ax in fig.axes:
+        for line in ax.get_lines():
+            xy = line.get_xydata()
+            if len(xy) > max_line_points:
+                keep = lttb_indices(xy[:, 0], xy[:, 1], max_line_points)
+                line.set_data(xy[keep, 0], xy[keep, 1])
+                label = line.get_label()
+                label = label if label and not label.startswith('_') else "line"
+                notes.append(f"{label}: {len(xy):,} → {len(keep):,} points (LTTB)")
+        scatters = [c for c in ax.collections if isinstance(c, PathCollection) and len(c.get_offsets()) > max_scatter_points]
+        for collection in scatters:
+            offsets = np.asarray(collection.get_offsets(), dtype=np.float64)
+            n = len(offsets)
+            single_colour = collection.get_array() is None and len(collection.get_facecolors()) <= 1
+            if len(scatters) == 1 and single_colour:
+                finite = np.isfinite(offsets).all(axis=1)
+                counts, x_edges, y_edges = np.histogram2d(offsets[finite, 0], offsets[finite, 1], bins=PLOT_DENSITY_BINS)
+                collection.remove()
+                mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), cmap='viridis')
+                fig.colorbar(mesh, ax=ax, label='points per bin')
+                notes.append(f"scatter: {n:,} points binned into a {PLOT_DENSITY_BINS}×{PLOT_DENSITY_BINS} density grid")
+                continue
+            keep = sample_indices(n, max_scatter_points)
+            collection.set_offsets(offsets[keep])
+            if collection.get_array() is not None and len(collection.get_array()) == n:
+                collection.set_array(np.asarray(collection.get_array())[keep])
+            for getter, setter in ((collection.get_facecolors, collection.set_facecolors),
+                                   (collection.get_edgecolors, collection.set_edgecolors),
+                                   (collection.get_sizes, collection.set_sizes)):
+                values = getter()
+                if len(values) == n:
+                    setter(values[keep])
+            notes.append(f"scatter: {n:,} → {len(keep):,} points (random sample)")
+    return notes
+
+
+def render_plot(code: str, dataframes: Dict, width: int = 10, height: int = 6, export_format: str = None,
+                downsample: bool = True) -> Dict:
+    """Execute one plot block against resident dataframes and capture what the chat needs to show it
+    Returns: {'kind', 'figure' (plotly) or 'image' and 'figure_pickle' (matplotlib PNG at screen
+    resolution and the pickled figure), 'exports', 'reductions' (notes on downsampled series), 'error'}
+    With export_format, only that download file is encoded, into 'exports'.
+    """
+    kind = 'plotly' if detect_plot_library(code) == 'plotly' else 'matplotlib'
+    entry = {'kind': kind, 'exports': {}, 'reductions': [], 'error': None}
+    try:
+        if kind == 'plotly':
+            namespace = {
+                '__builtins__': PLOT_BUILTINS,
+                'pd': pd,
+                'px': px,
+                'go': go,
+                **dataframes
+            }
+            # Add 'df' alias if single dataframe
+            if len(dataframes) == 1:
+                namespace['df'] = list(dataframes.values())[0]
+            exec(code, namespace)
+            # Get the figure from namespace if it was assigned to a variable
+            plotly_fig = next((namespace[var_name] for var_name in ['fig', 'figure'] if var_name in namespace), None)
+            if plotly_fig is not None:
+                plotly_fig.update_layout(width=width * 100, height=height * 100)
+                if downsample:
+                    entry['reductions'] = reduce_plotly_figure(plotly_fig)
+                if export_format:
+                    entry['exports'][export_format] = save_plot_to_bytes(plotly_fig, export_format, is_plotly=True).getvalue()
+                else:
+                    entry['figure'] = plotly_fig
+        else:
+            with MATPLOTLIB_LOCK:
+                fig = generate_plot_from_code(code, dataframes, width, height)
+                if fig:
+                    try:
+                        if downsample:
+                            entry['reductions'] = reduce_matplotlib_figure(fig)
+                        if export_format:
+                            entry['exports'][export_format] = save_plot_to_bytes(fig, export_format).getvalue()
+                        else:
+                            image = io.BytesIO()
+                            fig.savefig(image, format='png', dpi=PLOT_SCREEN_DPI, bbox_inches='tight')
+                            entry['image'] = image.getvalue()
+                    finally:
+                        plt.close(fig)
+                    if not export_format:
+                        # Pickled once detached from pyplot, so exports can redraw it without re-running the code
+                        try:
+                            entry['figure_pickle'] = pickle.dumps(fig)
+                        except Exception:
+                            pass
+    except Exception as e:
+        entry['error'] = str(e) or type(e).__name__
+        entry['error_type'] = type(e).__name__
+    return entry
+
+
+def read_spilled_frame(path: str) -> pd.DataFrame:
+    """Load a dataframe from an Arrow spill file written by the app"""
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all().to_pandas(split_blocks=True)
+
+
+def warm_plot_libraries():
+    """Render a throwaway figure so font loading and other first-draw setup happen before requests"""
+    fig = plt.figure(figsize=(2, 2))
+    try:
+        sns.histplot(x=[0, 1, 1, 2])
+        plt.title('warm-up')
+        fig.savefig(io.BytesIO(), format='png')
+    finally:
+        plt.close(fig)
+    px.line(x=[0, 1], y=[0, 1]).to_json()
+
+
+def serve_plot(request: tuple, baseline: Optional[int], memory_limit_mb: int) -> Dict:
+    """Worker side of a plot request; the Plotly figure travels back as its JSON spec"""
+    code, frames, width, height, export_format, downsample = request
+    start = time.perf_counter()
+    mapped_bytes = sum(os.path.getsize(value) for value in frames.values() if isinstance(value, str))
+    limit_address_space(baseline, memory_limit_mb, mapped_bytes)
+    try:
+        # Spilled frames arrive as Arrow file paths and are memory-mapped here
+        dataframes = {name: read_spilled_frame(value) if isinstance(value, str) else value for name, value in frames.items()}
+    except (OSError, MemoryError) as e:
+        return {'kind': None, 'exports': {}, 'error': f"Could not load plot data: {e}", 'error_type': type(e).__name__,
+                'exec_seconds': time.perf_counter() - start}
+    entry = render_plot(code, dataframes, width, height, export_format, downsample)
+    figure = entry.pop('figure', None)
+    if figure is not None:
+        entry['figure_json'] = figure.to_json()
+    entry['exec_seconds'] = time.perf_counter() - start
+    return entry
+
+
+def worker_main(fd: int, memory_limit_mb: int):
+    """Worker loop: answer one plot request at a time until the app closes the connection"""
+    conn = Connection(fd)
+    configure_plot_style()
+    plt.switch_backend('Agg')
+    warm_plot_libraries()
+    baseline = address_space_bytes()
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        kind, payload = request
+        if kind == 'plot':
+            reply = serve_plot(payload, baseline, memory_limit_mb)
+        else:
+            reply = {'error': f"Unknown request: {kind}"}
+        try:
+            conn.send(reply)
+        except (OSError, ValueError):
+            break
+
+
+def worker_environment() -> Dict[str, str]:
+    """Minimal environment for workers: no API keys or other secrets from the server's"""
+    env = {name: os.environ[name] for name in WORKER_ENV_VARS if name in os.environ}
+    env['MPLBACKEND'] = 'Agg'
+    return env
+
+
+class WorkerPool:
+    """Fixed set of clean Python interpreters running a worker script, one request at a time each
+    Workers are started with exec rather than forked from the threaded server (and rather than
+    multiprocessing's spawn, whose children would re-import the Streamlit script), get a minimal
+    environment and a scratch working directory, and run plot code with restricted builtins and
+    imports plus a time and memory limit. This contains runaway or careless code; it is not a
+    security boundary against deliberately hostile code.
+    A worker that times out or dies is killed and replaced, so the calling thread never hangs on it.
+    With idle_timeout_seconds, workers are only started when a request needs one and are stopped
+    again once they have sat idle that long, so a burst of work doesn't hold memory forever.
+    """
+
+    def __init__(self, size: int, memory_limit_mb: int, script: str = WORKER_SCRIPT, idle_timeout_seconds: float = None):
+        self.memory_limit_mb = memory_limit_mb
+        self.script = script
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.scratch_dir = tempfile.mkdtemp(prefix='doc-chat-worker-')
+        self.idle = queue.Queue()  # (worker or None, monotonic time it went idle)
+        for _ in range(size):
+            self.idle.put((None if idle_timeout_seconds else self._try_spawn(), time.monotonic()))
+        if idle_timeout_seconds:
+            threading.Thread(target=self._reap_idle, name='worker-reaper', daemon=True).start()
+
+    def _spawn(self) -> tuple:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        try:
+            process = subprocess.Popen(
+                [sys.executable, self.script, str(child_conn.fileno()), str(self.memory_limit_mb)],
+                pass_fds=(child_conn.fileno(),), env=worker_environment(), cwd=self.scratch_dir,
+                stdin=subprocess.DEVNULL
+            )
+        except OSError:
+            parent_conn.close()
+            raise
+        finally:
+            child_conn.close()
+        return process, parent_conn
+
+    def _try_spawn(self) -> Optional[tuple]:
+        """A new worker, or None to keep the slot and retry on its next use"""
+        try:
+            return self._spawn()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _stop(worker: tuple):
+        process, conn = worker
+        process.kill()
+        process.wait()
+        conn.close()
+
+    def _reap_idle(self):
+        """Stop workers that have been idle longer than idle_timeout_seconds, leaving their slots empty"""
+        while True:
+            time.sleep(self.idle_timeout_seconds / 2)
+            slots = []
+            while True:
+                try:
+                    slots.append(self.idle.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.monotonic()
+            for worker, idle_since in slots:
+                if worker is not None and now - idle_since > self.idle_timeout_seconds:
+                    self._stop(worker)
+                    worker = None
+                self.idle.put((worker, idle_since))
+
+    def run(self, kind: str, payload, timeout_seconds: float):
+        """Send one request to an idle worker and return its reply
+        Raises TimeoutError when no worker frees up or the reply doesn't arrive within
+        timeout_seconds, and ChildProcessError when the worker can't start or dies.
+        """
+        try:
+            worker, _ = self.idle.get(timeout=timeout_seconds)
+        except queue.Empty:
+            raise TimeoutError(f"All workers stayed busy for {timeout_seconds:g}s") from None
+        healthy = False
+        try:
+            if worker is None:
+                try:
+                    worker = self._spawn()
+                except OSError as e:
+                    raise ChildProcessError(f"Could not start a worker: {e}") from None
+            process, conn = worker
+            if process.poll() is not None:
+                raise EOFError
+            conn.send((kind, payload))
+            if not conn.poll(timeout_seconds):
+                raise TimeoutError(f"Timed out after {timeout_seconds:g}s")
+            reply = conn.recv()
+            healthy = True
+            return reply
+        except (TimeoutError, ChildProcessError):
+            raise
+        except (EOFError, OSError):
+            raise ChildProcessError("Worker crashed (the code may have exceeded the memory limit)") from None
+        finally:
+            if healthy:
+                self.idle.put((worker, time.monotonic()))
+            else:
+                if worker is not None:
+                    self._stop(worker)
+                # Always give the slot back, even when a replacement can't be started right now
+                self.idle.put((None if self.idle_timeout_seconds else self._try_spawn(), time.monotonic()))
+
+
+if __name__ == '__main__':
+    worker_main(int(sys.argv[1]), int(sys.argv[2]))